@@ -4,209 +4,870 @@ Lorenz Data Assimilation
 
 Simple solution of the Lorenz system in a deterministic and ensemble mode
 
+Command line use, see python lorenz_data_assimilation.py --help:
+    truth       deterministic base and modified runs, with the observations, saved as .npz
+    assimilate  data assimilation runs saved as .npz, without importing the plotting stack
+    plot        figures from saved assimilate results, with a non-interactive backend
+    sweep       cached parallel sweep over a grid of settings
+    online      filter run assimilating observations as they arrive from a tailed file or a local socket
+Without a command the complete workflow runs, saving the result figures.
+
 Scripted by dave.casson@usask.ca
 
 """
 
 
+import argparse
+import ast
+import os
 import numpy as np
 import logging
-import matplotlib.pyplot as plt
 logging.basicConfig(level=logging.INFO)
 from scripts import utilities as utils
-from scripts import lorenz_plotting
 from scripts import lorenz_array_prep
 from scripts import particle_filter as pf
 from scripts import ensemble_kalman_filter as enkf
+from scripts import ensemble_forecast
+from scripts import integrators
+from scripts import parallel_ensemble
+from scripts import ensemble_statistics
+from scripts import instrumentation
+from scripts import checkpoint
+from scripts import trajectory_store
+from scripts import truth_cache
+from scripts import models
+from scripts import adaptive_ensemble
+from scripts import ensemble_smoother
+
+def run_deterministic(tendency, param_arrays, initial_state, t_array, delta_t,
+                      integrator='euler', n_substeps=1, rtol=1e-6, atol=1e-6):
+    """Run a model (see models) using the chosen integrator to move forward in time, see integrators.create_stepper
+
+    param_arrays holds a (ntimesteps) array for each parameter of the tendency, initial_state is (nstate).
+    Returns the state array (nstate x ntimesteps)
+    """
+
+    #Initialize the state, its derivative and the stepper
+    state = np.array(initial_state, dtype=float)
+    derivative = np.zeros(len(state))
+    advance = integrators.create_stepper(tendency, delta_t, integrator, n_substeps, rtol, atol)
+    state_array = np.empty((len(state), len(t_array)))
+
+    #Loop through time, solving the model equations
+    for i, t in enumerate(t_array):
 
-def explicit_euler(quantity, flux, delta):
-    """Use the explicit euler approximation to advance one timestep"""
+        #The first timestep holds the initial conditions, after that each time through the loop
+        #the model advances one timestep
+        params = tuple(param_array[i] for param_array in param_arrays)
+        if i == 0:
+            tendency(state, *params, out=derivative)
+        else:
+            advance(state, derivative, params)
 
-    new_quantity = quantity + flux * delta
+        state_array[:, i] = state
 
-    return new_quantity
+    return state_array
 
-def predict(u_ini,v_ini,w_ini,du_dt,dv_dt,dw_dt,rho,psi,beta,delta_t):
-    """Advance one timestep by applying explicit euler to the state and derivative"""
+def run_lorenz_deterministic(rho_array, psi_array, beta_array, u_ini,v_ini,w_ini,t_array,delta_t,
+                             integrator='euler', n_substeps=1, rtol=1e-6, atol=1e-6):
+    """Run Lorenz-63 using the chosen integrator to move forward in time, see run_deterministic"""
+
+    return run_deterministic(ensemble_forecast.lorenz_derivative, (rho_array, psi_array, beta_array),
+                             [u_ini, v_ini, w_ini], t_array, delta_t, integrator, n_substeps, rtol, atol)
+
+
+def stream_lorenz_ensemble(settings, rho_ens_array, psi_ens_array, beta_ens_array, t_array, da_mode = None,
+                           observations = None, rng = None, profiler = None, checkpoint_writer = None,
+                           resume = None, parameter_statistics = None):
+    """stream_ensemble of Lorenz-63, with its rho, psi and beta ensemble arrays"""
+
+    return stream_ensemble(settings, (rho_ens_array, psi_ens_array, beta_ens_array), t_array, da_mode,
+                           observations, rng, profiler, checkpoint_writer, resume, parameter_statistics)
+
+
+def stream_ensemble(settings, params, t_array, da_mode = None, observations = None, rng = None, profiler = None,
+                    checkpoint_writer = None, resume = None, parameter_statistics = None, smoother = None):
+    """Generator form of run_ensemble, yielding (i, state_estimate, state_timestep_array) for each timestep
+
+    The model is chosen by settings['model'] (see models), params holds the (nens) ensemble array of each of its
+    parameters, e.g. from lorenz_array_prep.create_ens_arrays.
+    Only the current (nstate x nens) ensemble is held in memory. The yielded state array is the buffer that is
+    advanced in place, so a consumer that keeps it beyond the current timestep must copy it.
+    observations are the sparse Observations assimilated by the 'pf' or 'enkf' da_mode, see create_observations.
+    Between observation timesteps the ensemble is only forecast, the analysis runs at the observation timesteps.
+    rng is the np.random.Generator used for resampling and measurement perturbations,
+    by default seeded from settings['seed'] if present.
+    With settings['backend'] = process the forecast runs in num_workers processes, see parallel_ensemble
+    profiler is an instrumentation.Profiler timing each phase of the loop, by default nothing is recorded
+    checkpoint_writer(i, arrays, generator_states) is called every checkpoint_interval timesteps (and at the end),
+    once the consumers have taken timestep i. resume is a checkpoint (see checkpoint.load_checkpoint) to continue
+    the run from, after its last timestep
+    The parameters named by settings['estimate_parameters'] are estimated by state augmentation, updated by the
+    analysis with the states (see assimilation_loop). Their estimates and ensemble are added to
+    parameter_statistics, an EnsembleStatistics with a row for each estimated parameter, if given
+    With settings['adaptive_ensemble'] the number of members changes at the analysis steps, see adaptive_ensemble
+    smoother is an ensemble_smoother.FixedLagSmoother of the enkf, which keeps the latest ensembles and updates them
+    with each analysis
+    """
+
+    if da_mode is not None and observations is None:
+        raise ValueError(f'Observations are required to run data assimilation mode {da_mode}')
+    adaptive_ensemble.check_settings(settings)
+    if smoother is not None and (da_mode != 'enkf' or settings['adaptive_ensemble']):
+        raise ValueError('The fixed-lag smoother needs the enkf with a fixed ensemble size')
+
+    model = models.get_model(settings)
+
+    # Initialize the (nstate x nens) state and derivative arrays, which are advanced in place by the integrator
+    state_timestep_array, state_derivative_array = ensemble_forecast.initialize_ensemble(
+        settings, model.initial_state(settings, 'mod'))
+    # The parameters are copied, as estimated parameters are updated in place
+    params = tuple(np.array(param, dtype=state_timestep_array.dtype) for param in params)
+    H = lorenz_array_prep.observation_operator(settings)
+    if profiler is None:
+        profiler = instrumentation.NULL_PROFILER
+
+    if resume is not None:
+        # The checkpointed ensemble replaces the initial one, its size differs with an adaptive ensemble
+        state_timestep_array = np.array(resume['state'], dtype=state_timestep_array.dtype)
+        state_derivative_array = np.array(resume['derivative'], dtype=state_derivative_array.dtype)
+        params = tuple(np.array(resume['params'], dtype=state_timestep_array.dtype))
+        if smoother is not None:
+            smoother.set_state(resume)
+
+    if settings['backend'] == 'process':
+        # Shards of members are forecast by worker processes, on the ensemble held in shared memory.
+        # The driver and every shard draw from their own stream spawned from the seed
+        seed_sequences = np.random.SeedSequence(settings.get('seed')).spawn(settings['num_workers'] + 1)
+        if rng is None:
+            rng = np.random.default_rng(seed_sequences[0])
+
+        sharded_ensemble = parallel_ensemble.ShardedEnsemble(settings, state_timestep_array, state_derivative_array,
+                                                             params, len(H), settings['num_workers'],
+                                                             seed_sequences[1:])
+        try:
+            if resume is not None:
+                checkpoint.restore_generator(rng, resume['generator_states']['rng'])
+                sharded_ensemble.set_state(resume['generator_states']['forecast'])
+
+            yield from assimilation_loop(settings, sharded_ensemble.state, sharded_ensemble.derivative,
+                                         tuple(sharded_ensemble.params),
+                                         lambda *arrays: sharded_ensemble.forecast(),
+                                         sharded_ensemble.standard_normal, t_array, da_mode, observations, H, rng,
+                                         profiler, sharded_ensemble.get_state, checkpoint_writer, resume,
+                                         parameter_statistics, smoother)
+        finally:
+            sharded_ensemble.close()
+
+    else:
+        if rng is None:
+            rng = np.random.default_rng(settings.get('seed'))
+
+        advance = integrators.create_stepper_from_settings(settings, model.tendency)
+
+        if resume is not None:
+            checkpoint.restore_generator(rng, resume['generator_states']['rng'])
+            advance.controller.update(resume['generator_states']['forecast'])
+
+        yield from assimilation_loop(settings, state_timestep_array, state_derivative_array, params, advance,
+                                     None, t_array, da_mode, observations, H, rng, profiler,
+                                     lambda: advance.controller, checkpoint_writer, resume, parameter_statistics,
+                                     smoother)
+
+
+def assimilation_loop(settings, state_timestep_array, state_derivative_array, params, forecast, standard_normal,
+                      t_array, da_mode, observations, H, rng, profiler, forecast_state, checkpoint_writer, resume,
+                      parameter_statistics=None, smoother=None):
+    """Forecast and analysis loop of stream_ensemble, on state and derivative arrays that are updated in place
+
+    forecast(state, derivative, params) advances the ensemble arrays one timestep in place. The arrays are only
+    replaced when an adaptive ensemble is resized. standard_normal() returns the (nobs x nens) draws for the EnKF
+    measurement perturbations, or is None to draw them from rng. Each phase is timed by the profiler.
+    forecast_state() returns the integrator (and shard generator) state saved in checkpoints.
+
+    Estimated parameters are resampled with the particles and then jittered by a multiplicative parameter_jitter
+    noise, or appended to the state vector of the EnKF update after their anomalies are inflated by
+    parameter_inflation. Both keep the parameter ensemble from collapsing.
+
+    With an adaptive ensemble, the ensemble is resized after the analysis to the size given by
+    adaptive_ensemble.target_ensemble_size, from the spread ratio of the forecast and the effective sample fraction
+    of the particle weights.
+
+    The ensemble of each timestep is pushed to the smoother once analysed, and the EnKF analysis updates the
+    ensembles it holds. The smoother is flushed at the end of the run.
+    """
+
+    # A resumed run continues after the last timestep of its checkpoint
+    first_step = resume['step'] + 1 if resume is not None else 0
+    last_step = len(t_array) - 1
+
+    # Timestep of the first observation
+    observation_steps = observations.index if observations is not None else np.empty(0, dtype=int)
+    k = np.searchsorted(observation_steps, first_step)
+    next_observation_step = observation_steps[k] if k < len(observation_steps) else -1
+
+    # Particle weights are carried between timesteps in the log domain, starting equal
+    if resume is not None:
+        log_weights = resume['log_weights'].copy()
+    else:
+        num_ens = state_timestep_array.shape[1]
+        log_weights = np.full(num_ens, -np.log(num_ens))
+    weights = np.exp(log_weights)
+    # Consecutive well conditioned analyses of an adaptive ensemble, see adaptive_ensemble.target_ensemble_size
+    well_conditioned_analyses = int(resume['well_conditioned_analyses']) if resume is not None else 0
+
+    tendency = models.get_model(settings).tendency
+    n_state = len(state_timestep_array)
+
+    # Parameter arrays estimated by state augmentation, (nparams) views updated in place
+    estimated_params = [params[j] for j in lorenz_array_prep.estimated_parameter_index(settings)]
+
+    # Loop iterates through the timesteps, advancing all ensemble members together
+    for i in range(first_step, len(t_array)):
+        profiler.timestep = i
+        profiler.count('timesteps')
+
+        # The first timestep holds the initial conditions, after that all members advance one timestep together
+        with profiler.phase('forecast'):
+            if i == 0:
+                tendency(state_timestep_array, *params, out=state_derivative_array)
+            else:
+                forecast(state_timestep_array, state_derivative_array, params)
+
+        # The analysis only runs on timesteps with an observation, otherwise this is a pure forecast step
+        analysis_step = i == next_observation_step
+        if analysis_step:
+            z, variance = observations.values[k], observations.variance[k]
+            k += 1
+            next_observation_step = observation_steps[k] if k < len(observation_steps) else -1
+            # A missing (NaN) observation, e.g. one that never arrived in an online run, leaves a forecast step
+            analysis_step = not np.isnan(z).any()
+            if analysis_step:
+                profiler.count('analysis_steps')
+                n_eff_fraction = None
+                if settings['adaptive_ensemble']:
+                    with profiler.phase('estimate'):
+                        spread = adaptive_ensemble.spread_ratio(state_timestep_array, z, H, variance)
+
+        if da_mode is None:
+            with profiler.phase('estimate'):
+                state_estimate = np.mean(state_timestep_array, axis=1, dtype=np.float64)
 
-    #Explicit euler solution
-    u = explicit_euler(u_ini,du_dt,delta_t)
-    v = explicit_euler(v_ini, dv_dt, delta_t)
-    w = explicit_euler(w_ini, dw_dt, delta_t)
+        if da_mode == 'pf':
+            """Implement Particle Filter SIS or SIR algorithms. See the particle_filter.py for details"""
+            if i == 0:
+                logging.info('Running Particle Filter')
 
-    #Lorenz equations
-    du_dt = rho * (v - u)
-    dv_dt = u * (psi - w) - v
-    dw_dt = u * v - beta * w
+            if analysis_step:
+                with profiler.phase('likelihood'):
+                    log_likelihoods = pf.calculate_log_likelihoods(settings, state_timestep_array, z, H, variance)
+                with profiler.phase('weighting'):
+                    log_weights     = pf.normalize_log_weights(log_weights + log_likelihoods)
+                    weights         = np.exp(log_weights)
+                    effective_weight = pf.calculate_neff(weights)
+                    n_eff_fraction = effective_weight / len(weights)
+                profiler.record('n_eff', effective_weight)
+
+            with profiler.phase('estimate'):
+                state_estimate = pf.calculate_state_estimate(state_timestep_array, weights)
 
-    return u,v,w,du_dt,dv_dt,dw_dt
+            # Resample once the effective number of particles falls below the threshold
+            if analysis_step and settings['resample_option'] == True:
+                n_eff            = settings['n_eff'] * len(weights)
+
+                if effective_weight < n_eff:
+                    with profiler.phase('resample'):
+                        resample_index = pf.resample_index(settings, weights, rng)
+                        state_timestep_array[:] = state_timestep_array[:, resample_index]
+                        state_derivative_array[:] = state_derivative_array[:, resample_index]
+                        for param in estimated_params:
+                            param[:] = param[resample_index] * (1 + settings['parameter_jitter'] *
+                                                                rng.standard_normal(len(param)))
+                        if estimated_params:
+                            tendency(state_timestep_array, *params, out=state_derivative_array)
+                        # Re-initialize weights for the next run
+                        log_weights.fill(-np.log(len(weights)))
+                        weights = np.exp(log_weights)
+                    profiler.count('resample_events')
 
-def run_lorenz_deterministic(rho_array, psi_array, beta_array, u_ini,v_ini,w_ini,t_array,delta_t):
-    """Run Lorenz using the predict function to move forward in time"""
+        if da_mode == 'enkf':
+            """Implement Ensemble Kalman Filter. See ensemble_kalman_filter.py for details"""
+            if i == 0:
+                logging.info('Running EnKF')
 
-    #Initialize variables and arrays
-    u = u_ini
-    v = v_ini
-    w = w_ini
-    du_dt = 0
-    dv_dt = 0
-    dw_dt = 0
-    u_array = []
-    v_array = []
-    w_array = []
+            if analysis_step:
+                with profiler.phase('enkf_gain'):
+                    R = lorenz_array_prep.observation_error_variance(settings, len(z), variance)
+                    perturbations = standard_normal() if standard_normal is not None else None
+                    lagged_states = smoother.lagged_states() if smoother is not None else None
+                    if estimated_params:
+                        # Augmented state [states, parameters], the parameters are only observed through
+                        # their covariance with the states
+                        for param in estimated_params:
+                            param_mean = np.mean(param)
+                            param[:] = param_mean + settings['parameter_inflation'] * (param - param_mean)
+                        augmented_state = np.vstack([state_timestep_array, *estimated_params])
+                        H_augmented = np.hstack([H, np.zeros((len(H), len(estimated_params)))])
+                        augmented_state, augmented_estimate = enkf.update_enkf(settings, augmented_state, z,
+                                                                               H_augmented, R, rng, perturbations,
+                                                                               lagged_states)
+                        state_timestep_array[:] = augmented_state[:n_state]
+                        state_estimate = augmented_estimate[:n_state]
+                        for param, updated_param in zip(estimated_params, augmented_state[n_state:]):
+                            param[:] = updated_param
+                    else:
+                        state_timestep_array[:], state_estimate = enkf.update_enkf(settings, state_timestep_array,
+                                                                                   z, H, R, rng, perturbations,
+                                                                                   lagged_states)
+                # The derivative is re-evaluated at the updated states, for the next forecast step
+                with profiler.phase('forecast'):
+                    tendency(state_timestep_array, *params, out=state_derivative_array)
+            else:
+                with profiler.phase('estimate'):
+                    state_estimate = np.mean(state_timestep_array, axis=1, dtype=np.float64)
+
+        if analysis_step and settings['adaptive_ensemble'] and da_mode is not None:
+            num_ens, well_conditioned_analyses = adaptive_ensemble.target_ensemble_size(
+                settings, len(weights), spread, n_eff_fraction, well_conditioned_analyses)
+            if num_ens != len(weights):
+                # The resized members are drawn by weight and start with equal weights, the estimate of this
+                # timestep is that of the analysis
+                with profiler.phase('resize'):
+                    member_weights = weights if da_mode == 'pf' else np.full(len(weights), 1. / len(weights))
+                    state_timestep_array, params = adaptive_ensemble.resize_ensemble(
+                        settings, state_timestep_array, params, member_weights, num_ens, rng)
+                    estimated_params = [params[j] for j in lorenz_array_prep.estimated_parameter_index(settings)]
+                    state_derivative_array = np.empty_like(state_timestep_array)
+                    tendency(state_timestep_array, *params, out=state_derivative_array)
+                    log_weights = np.full(num_ens, -np.log(num_ens))
+                    weights = np.exp(log_weights)
+                profiler.count('ensemble_resizes')
+            profiler.record('num_ens', num_ens)
+
+        if parameter_statistics is not None:
+            with profiler.phase('estimate'):
+                parameter_ensemble = np.array(estimated_params)
+                if da_mode == 'pf':
+                    parameter_estimate = pf.calculate_state_estimate(parameter_ensemble, weights)
+                else:
+                    parameter_estimate = np.mean(parameter_ensemble, axis=1, dtype=np.float64)
+                parameter_statistics.update(i, parameter_estimate, parameter_ensemble)
+
+        if smoother is not None:
+            with profiler.phase('smoother'):
+                smoother.push(i, state_timestep_array)
+
+        yield i, np.asarray(state_estimate), state_timestep_array
+
+        # Checkpoint once the consumers have taken this timestep, so that their results are complete up to it
+        if checkpoint_writer is not None and ((i + 1) % settings['checkpoint_interval'] == 0 or i == last_step):
+            checkpoint_writer(i,
+                              {'state': state_timestep_array,
+                               'derivative': state_derivative_array,
+                               'params': np.array(params),
+                               'log_weights': log_weights,
+                               'well_conditioned_analyses': np.array(well_conditioned_analyses),
+                               **(smoother.get_state() if smoother is not None else {})},
+                              {'rng': rng.bit_generator.state, 'forecast': forecast_state()})
+
+    if smoother is not None:
+        smoother.flush()
+
+
+def stream_blocks(ensemble_stream, block_size, num_ens):
+    """Group a stream_ensemble generator into blocks of timesteps
+
+    Yields (first_timestep, state_estimate_block, state_block) with shapes (nblock x nstate) and
+    (nblock x nstate x nens). The block buffers are reused, so peak memory is set by block_size rather than the
+    run length. num_ens is the capacity of the block, members beyond the size of an adaptive ensemble are NaN.
+    """
+
+    state_estimate_block = state_block = None
+
+    n = 0
+    for i, state_estimate, state_timestep_array in ensemble_stream:
+        # The buffers are allocated from the first timestep, once the state dimension is known
+        if state_block is None:
+            state_estimate_block = np.empty((block_size,) + np.shape(state_estimate))
+            state_block = np.empty((block_size, len(state_timestep_array), num_ens),
+                                   dtype=state_timestep_array.dtype)
+
+        num_members = state_timestep_array.shape[1]
+        state_estimate_block[n] = state_estimate
+        state_block[n, :, :num_members] = state_timestep_array
+        state_block[n, :, num_members:] = np.nan
+        n += 1
+
+        if n == block_size:
+            yield i - n + 1, state_estimate_block, state_block
+            n = 0
+
+    if n > 0:
+        yield i - n + 1, state_estimate_block[:n], state_block[:n]
+
+
+def broadcast_stream(ensemble_stream, consumers, profiler = instrumentation.NULL_PROFILER):
+    """Drive an ensemble stream, passing each yielded item to every consumer e.g. consumer(i, state_estimate, state)"""
+
+    for item in ensemble_stream:
+        with profiler.phase('result_append'):
+            for consumer in consumers:
+                consumer(*item)
+
+
+def checkpoint_hooks(settings, da_mode, resume, result_arrays):
+    """Checkpointing of a run whose accumulated results are result_arrays (a dictionary of arrays filled as it runs)
+
+    Returns the checkpoint to resume from, if resume is True and a checkpoint exists (the result arrays are restored
+    from it in place), and the checkpoint writer, if settings['checkpoint_interval'] is positive
+    """
+
+    path = checkpoint.checkpoint_path(settings, da_mode)
+
+    resume_checkpoint = checkpoint.load_checkpoint(path, settings, da_mode) if resume else None
+    if resume_checkpoint is not None:
+        for name, result_array in result_arrays.items():
+            result_array[...] = resume_checkpoint[f'result_{name}']
+
+    def checkpoint_writer(i, arrays, generator_states):
+        arrays = dict(arrays, **{f'result_{name}': result_array for name, result_array in result_arrays.items()})
+        checkpoint.save_checkpoint(path, settings, da_mode, i, arrays, generator_states)
+
+    return resume_checkpoint, checkpoint_writer if settings['checkpoint_interval'] > 0 else None
+
+
+def run_lorenz_ensemble(settings, rho_ens_array, psi_ens_array, beta_ens_array, t_array, da_mode = None,
+                        observations = None, rng = None, profiler = None, resume = False):
+    """run_ensemble of Lorenz-63, with its rho, psi and beta ensemble arrays"""
+
+    return run_ensemble(settings, (rho_ens_array, psi_ens_array, beta_ens_array), t_array, da_mode, observations,
+                        rng, profiler, resume)
+
+def run_ensemble(settings, params, t_array, da_mode = None, observations = None, rng = None, profiler = None,
+                 resume = False):
+    """Run the model (with options for data assimilation) using an ensemble of different parameter settings
+
+    See stream_ensemble for the model, data assimilation and profiler arguments. With a positive
+    checkpoint_interval setting the run (including its result arrays) is checkpointed to checkpoint_path,
+    and with resume it continues from the latest checkpoint, giving the same result as an uninterrupted run.
+    Returns the ensemble states (ntimesteps x nstate x nens) and the state estimates (ntimesteps x nstate).
+    With an adaptive ensemble nens is max_ens, and the members beyond the ensemble size of each timestep are NaN
+    """
+
+    #Initialize result arrays, allocated once for the whole run: (ntimesteps x nstate x nens) and (ntimesteps x nstate)
+    #The ensemble is stored in the ensemble dtype of the settings
+    n_state = models.get_model(settings).n_state(settings)
+    state_result_array = np.empty((len(t_array), n_state, adaptive_ensemble.ensemble_capacity(settings)),
+                                  dtype=ensemble_forecast.ensemble_dtype(settings))
+    state_estimate_array = np.empty((len(t_array), n_state))
+    if profiler is None:
+        profiler = instrumentation.NULL_PROFILER
+    resume_checkpoint, checkpoint_writer = checkpoint_hooks(settings, da_mode, resume,
+                                                            {'ensemble': state_result_array,
+                                                             'estimate': state_estimate_array})
 
-    #Loop through time, solving the lorenz equation
-    for i, t in enumerate(t_array):
+    for i, state_estimate, state_timestep_array in stream_ensemble(settings, params, t_array, da_mode, observations,
+                                                                   rng, profiler, checkpoint_writer,
+                                                                   resume_checkpoint):
+        with profiler.phase('result_append'):
+            num_members = state_timestep_array.shape[1]
+            state_estimate_array[i] = state_estimate
+            state_result_array[i, :, :num_members] = state_timestep_array
+            state_result_array[i, :, num_members:] = np.nan
 
-        #Each time through the loop, advance the model one timestep
-        u, v, w, du_dt, dv_dt, dw_dt = predict(u,v,w,du_dt,dv_dt,dw_dt,rho_array[i],psi_array[i],beta_array[i],delta_t)
+    return state_result_array, state_estimate_array
 
-        u_array.append(u)
-        v_array.append(v)
-        w_array.append(w)
+def run_lorenz_ensemble_statistics(settings, rho_ens_array, psi_ens_array, beta_ens_array, t_array, da_mode = None,
+                                   observations = None, rng = None, profiler = None, resume = False,
+                                   consumers = (), parameter_statistics = None):
+    """run_ensemble_statistics of Lorenz-63, with its rho, psi and beta ensemble arrays"""
+
+    return run_ensemble_statistics(settings, (rho_ens_array, psi_ens_array, beta_ens_array), t_array, da_mode,
+                                   observations, rng, profiler, resume, consumers, parameter_statistics)
+
+def run_ensemble_statistics(settings, params, t_array, da_mode = None, observations = None, rng = None,
+                            profiler = None, resume = False, consumers = (), parameter_statistics = None,
+                            smoother_statistics = None):
+    """Run the model ensemble, keeping only the per-timestep statistics (estimate, mean, spread and quantiles)
+
+    Returns an EnsembleStatistics, without materializing the full ensemble history.
+    Checkpoints hold the statistics accumulated so far, see run_ensemble for checkpointing and resume.
+    consumers are further stream consumers, e.g. a trajectory_store.TrajectoryWriter.
+    parameter_statistics collects the estimated parameters, see stream_ensemble
+    smoother_statistics collects the ensembles of the fixed-lag smoother of settings['smoother_lag'] timesteps,
+    see ensemble_smoother
+    """
+
+    n_state = models.get_model(settings).n_state(settings)
+    statistics = ensemble_statistics.EnsembleStatistics(len(t_array), n_state)
+    if profiler is None:
+        profiler = instrumentation.NULL_PROFILER
+    result_arrays = {'estimate': statistics.estimate,
+                     'mean': statistics.mean,
+                     'spread': statistics.spread,
+                     'quantiles': statistics.quantiles}
+    if parameter_statistics is not None:
+        result_arrays.update({'parameter_estimate': parameter_statistics.estimate,
+                              'parameter_mean': parameter_statistics.mean,
+                              'parameter_spread': parameter_statistics.spread,
+                              'parameter_quantiles': parameter_statistics.quantiles})
+    smoother = None
+    if smoother_statistics is not None:
+        smoother = ensemble_smoother.FixedLagSmoother(settings['smoother_lag'], n_state, settings['num_ens'],
+                                                      ensemble_forecast.ensemble_dtype(settings),
+                                                      [smoother_statistics])
+        result_arrays.update({'smoother_estimate': smoother_statistics.estimate,
+                              'smoother_mean': smoother_statistics.mean,
+                              'smoother_spread': smoother_statistics.spread,
+                              'smoother_quantiles': smoother_statistics.quantiles})
+    resume_checkpoint, checkpoint_writer = checkpoint_hooks(settings, da_mode, resume, result_arrays)
 
-    state_array = np.vstack([u_array,v_array,w_array])
+    broadcast_stream(stream_ensemble(settings, params, t_array, da_mode, observations, rng, profiler,
+                                     checkpoint_writer, resume_checkpoint, parameter_statistics, smoother),
+                     [statistics, *consumers], profiler)
 
-    return state_array
+    return statistics
+
+
+def run_truth(settings):
+    """Run the base ("truth") and modified deterministic runs of the model.
+    Returns the time array and both (nstate x ntimesteps) runs"""
+
+    model   = models.get_model(settings)
+    t_array = lorenz_array_prep.create_time_array(settings)
+
+    state_array_base_run = run_deterministic(model.tendency,
+                                             lorenz_array_prep.create_parameter_arrays(settings, 'base'),
+                                             model.initial_state(settings, 'base'),
+                                             t_array, settings['delta_t'], settings['integrator'],
+                                             settings['n_substeps'], settings['rtol'], settings['atol'])
+
+    state_array_mod_run = run_deterministic(model.tendency,
+                                            lorenz_array_prep.create_parameter_arrays(settings, 'mod'),
+                                            model.initial_state(settings, 'mod'),
+                                            t_array, settings['delta_t'], settings['integrator'],
+                                            settings['n_substeps'], settings['rtol'], settings['atol'])
+
+    return t_array, state_array_base_run, state_array_mod_run
+
+
+def run_truth_and_observations(settings):
+    """run_truth and the observations of the truth run. With the truth_cache_dir setting these are reused from
+    the disk cache when a run with the same truth settings has computed them, see truth_cache
+
+    Returns the time array, both (nstate x ntimesteps) runs and the Observations
+    """
+
+    cache_dir = settings['truth_cache_dir']
+    if cache_dir != 'None':
+        cached_truth = truth_cache.load_truth(cache_dir, settings)
+        if cached_truth is not None:
+            return cached_truth
+
+    t_array, state_array_base_run, state_array_mod_run = run_truth(settings)
+    observations = lorenz_array_prep.create_observations(settings, state_array_base_run)
+
+    if cache_dir != 'None':
+        truth_cache.store_truth(cache_dir, settings, t_array, state_array_base_run, state_array_mod_run,
+                                observations, settings['truth_cache_max_mb'] * 1e6)
+
+    return t_array, state_array_base_run, state_array_mod_run, observations
+
+
+def create_trajectory_writer(settings, directory, results, observations, da_mode, append=False):
+    """TrajectoryWriter of a filter run, holding the time array, truth and modified runs and the observations"""
+
+    compression = None if settings['store_compression'] == 'None' else settings['store_compression']
+    writer = trajectory_store.TrajectoryWriter(directory, settings['num_timesteps'], len(results['base_run']),
+                                               adaptive_ensemble.ensemble_capacity(settings), compression,
+                                               settings['store_chunk_size'],
+                                               {'da_mode': da_mode, 'settings': settings}, append,
+                                               ensemble_forecast.ensemble_dtype(settings))
+    for name in ['t_array', 'base_run', 'mod_run']:
+        writer.write_array(name, results[name])
+    writer.write_observations(observations)
+
+    return writer
+
+
+DA_MODES = ('pf', 'enkf')
+
+
+def experiment_generators(settings):
+    """Independent random generators spawned from settings['seed'] (if present): one for the ensemble parameters
+    and one for each da_mode, so that the run of a filter does not depend on which other filters ran"""
+
+    parameter_seed, *filter_seeds = np.random.SeedSequence(settings.get('seed')).spawn(1 + len(DA_MODES))
+
+    return (np.random.default_rng(parameter_seed),
+            {da_mode: np.random.default_rng(seed) for da_mode, seed in zip(DA_MODES, filter_seeds)})
+
+
+def run_experiment(settings, profilers=None, resume=False, store_directory=None):
+    """Run the complete workflow for one configuration without plotting: truth and modified runs, measurements,
+    and each filter enabled by run_pf and run_enkf. Random draws are seeded from settings['seed'] if present,
+    see experiment_generators.
+    profilers optionally maps a da_mode to the instrumentation.Profiler of its run.
+    With resume each filter continues from its latest checkpoint, see run_ensemble.
+    With a store_directory the full run of each filter is also streamed into a trajectory store,
+    store_directory/{da_mode}, see trajectory_store.
 
+    Returns a dictionary of arrays, with the EnsembleStatistics and the estimate RMSE against the truth of each filter,
+    the ensemble size of each timestep with an adaptive ensemble, and the smoothed estimate of the enkf with a
+    positive smoother_lag
+    """
 
-def run_lorenz_ensemble(settings, rho_ens_array, psi_ens_array, beta_ens_array, t_array, da_mode = None):
-    """Run the Lorenz model (with options for data assimilation) using an ensemble of different parameter settings"""
+    if profilers is None:
+        profilers = {}
 
-    # Initialize values
-    u = settings['u_ini_mod']
-    v = settings['v_ini_mod']
-    w = settings['w_ini_mod']
-    du_dt = 0
-    dv_dt = 0
-    dw_dt = 0
+    parameter_rng, filter_rngs = experiment_generators(settings)
 
-    #Initialize result array
-    state_estimate_array = []
-    state_result_array = []
+    t_array, state_array_base_run, state_array_mod_run, observations = run_truth_and_observations(settings)
+    params = lorenz_array_prep.create_ens_arrays(settings, parameter_rng)
 
-    # Initial loop iterates through the timesteps
-    for i, t in enumerate(t_array):
+    results = {'t_array': t_array,
+               'base_run': state_array_base_run,
+               'mod_run': state_array_mod_run,
+               'observation_index': observations.index,
+               'observation_values': observations.values,
+               'observation_variance': observations.variance}
 
-        u_ens_array = []
-        v_ens_array = []
-        w_ens_array = []
-        du_ens_array = []
-        dv_ens_array = []
-        dw_ens_array = []
-
-        # Second loop iterates through ensemble members
-        for ens in range(0, settings['num_ens']):
-
-            # For every timestep, except the first,
-            # the variables and derivative variables are updated from the previous timestep
-            if i > 0:
-                u = state_timestep_array[0][ens]
-                v = state_timestep_array[1][ens]
-                w = state_timestep_array[2][ens]
-                du_dt = state_derivative_array[0][ens]
-                dv_dt = state_derivative_array[1][ens]
-                dw_dt = state_derivative_array[2][ens]
-
-            # Use the predict function to move one timestep forward
-            u_new, v_new, w_new, du_dt_new, dv_dt_new, dw_dt_new = predict(u, v, w, du_dt, dv_dt, dw_dt,
-                                                                           rho_ens_array[ens], psi_ens_array[ens],
-                                                                           beta_ens_array[ens],
-                                                                           settings['delta_t'])
-
-            # Append the state and derivative variables to create am array containing each ensemble member
-            u_ens_array.append(u_new)
-            v_ens_array.append(v_new)
-            w_ens_array.append(w_new)
-            du_ens_array.append(du_dt_new)
-            dv_ens_array.append(dv_dt_new)
-            dw_ens_array.append(dw_dt_new)
-
-        # Append the ensemble results for each timestep
-        state_timestep_array = np.vstack([u_ens_array, v_ens_array, w_ens_array])
-        state_derivative_array = np.vstack([du_ens_array, dv_ens_array, dw_ens_array])
+    for da_mode in DA_MODES:
+        if settings[f'run_{da_mode}'] == True:
+            consumers = []
+            if store_directory is not None:
+                consumers.append(create_trajectory_writer(settings, os.path.join(store_directory, da_mode), results,
+                                                          observations, da_mode, append=resume))
+            if settings['adaptive_ensemble']:
+                ensemble_size = np.zeros(len(t_array), dtype=int)
 
+                def record_ensemble_size(i, state_estimate, state_timestep_array):
+                    ensemble_size[i] = state_timestep_array.shape[1]
 
+                consumers.append(record_ensemble_size)
 
-        if da_mode == 'pf':
-            """Implement Particle Filter SIS or SIR algorithms. See the particle_filter.py for details"""
-            if i == 0:
-                logging.info('Running Particle Filter')
+            parameter_index = lorenz_array_prep.estimated_parameter_index(settings)
+            parameter_statistics = ensemble_statistics.EnsembleStatistics(len(t_array), len(parameter_index)) \
+                if parameter_index else None
 
-            likelihoods      = pf.calculate_likelihoods(settings, state_timestep_array,meas_array[i])
-            weights          = pf.calculate_weights(likelihoods)
-            state_estimate   = pf.calculate_state_estimate(state_timestep_array, weights)
-            effective_weight = pf.calculate_neff(weights)
-            n_eff            = settings['n_eff'] * settings['num_ens']
+            smoother_statistics = ensemble_statistics.EnsembleStatistics(len(t_array), len(state_array_base_run)) \
+                if da_mode == 'enkf' and settings['smoother_lag'] > 0 else None
 
-            if settings['resample_option'] == True and n_eff < effective_weight:
-                if i == 0:
-                    logging.info('Particle Filter with resampling')
-                state_timestep_array = pf.resample(settings, state_timestep_array, weights)
-                state_estimate = pf.calculate_state_estimate(state_timestep_array, weights)
-                # Re-initialize weights for the next run
-                weights.fill(1.0 / settings['num_ens'])
+            statistics = run_ensemble_statistics(settings, params, t_array, da_mode, observations,
+                                                 filter_rngs[da_mode], profilers.get(da_mode), resume, consumers,
+                                                 parameter_statistics, smoother_statistics)
+            for consumer in consumers:
+                if hasattr(consumer, 'close'):
+                    consumer.close()
 
-        if da_mode == 'enkf':
-            """Implement Ensemble Kalman Filter. See ensemble_kalman_filter.py for details"""
-            if i == 0:
-                logging.info('Running EnKF')
-            state_timestep_array, state_estimate = enkf.update_enkf(settings, state_timestep_array, meas_array[i])
+            results[f'{da_mode}_estimate'] = statistics.estimate
+            results[f'{da_mode}_mean'] = statistics.mean
+            results[f'{da_mode}_spread'] = statistics.spread
+            results[f'{da_mode}_quantiles'] = statistics.quantiles
+            results[f'{da_mode}_quantile_levels'] = statistics.quantile_levels
+            results[f'{da_mode}_rmse'] = np.sqrt(np.mean((statistics.estimate - state_array_base_run.T) ** 2, axis=0))
+            if settings['adaptive_ensemble']:
+                results[f'{da_mode}_num_ens'] = ensemble_size
 
-        state_estimate_array.append(state_estimate)
-        state_result_array.append(state_timestep_array)
+            if smoother_statistics is not None:
+                results[f'{da_mode}_smoother_estimate'] = smoother_statistics.estimate
+                results[f'{da_mode}_smoother_spread'] = smoother_statistics.spread
+                results[f'{da_mode}_smoother_rmse'] = np.sqrt(np.mean((smoother_statistics.estimate -
+                                                                       state_array_base_run.T) ** 2, axis=0))
 
-    return state_result_array, state_estimate_array
+            if parameter_statistics is not None:
+                parameter_names = np.array(models.get_model(settings).parameter_names)
+                results[f'{da_mode}_parameter_names'] = parameter_names[parameter_index]
+                results[f'{da_mode}_parameter_estimate'] = parameter_statistics.estimate
+                results[f'{da_mode}_parameter_spread'] = parameter_statistics.spread
+                results[f'{da_mode}_parameter_quantiles'] = parameter_statistics.quantiles
 
+    return results
 
-if __name__ == '__main__':
 
-    logging.info('Read settings from settings file.')
-    settings = utils.read_settings()
+def parse_override(text):
+    """Parse a key=value1,value2 sweep argument into (key, [values]), with each value read as a python literal
+    where possible, e.g. num_ens=50,100 or resample_scheme=systematic,residual. None stays the text 'None', as
+    in a settings file, e.g. localization_radius=None,4"""
+
+    key, values = text.split('=', 1)
+
+    parsed_values = []
+    for value in values.split(','):
+        if value.strip() == 'None':
+            parsed_values.append('None')
+            continue
+        try:
+            parsed_values.append(ast.literal_eval(value))
+        except (ValueError, SyntaxError):
+            parsed_values.append(value)
+
+    return key.strip().lower(), parsed_values
+
+
+def plot_results(results, settings, show=False, decimate=True):
+    """Plot the data assimilation results of every filter in a saved run_experiment result
+
+    Without show, the figures are rendered in parallel worker processes with the Agg backend and only written
+    to file. decimate reduces the series to the pixel width of the figure, see lorenz_plotting.plot_da_result
+    """
+
+    #The plotting stack is only imported here, so that runs without figures never load it
+    import matplotlib
+    if not show:
+        matplotlib.use('Agg')
+    from scripts import lorenz_plotting
+
+    observations = lorenz_array_prep.Observations(results['observation_index'], results['observation_values'],
+                                                  results['observation_variance'])
+
+    statistics_by_mode = {}
+    for da_mode in DA_MODES:
+        if f'{da_mode}_estimate' in results:
+            statistics_by_mode[da_mode] = ensemble_statistics.EnsembleStatistics.from_arrays(
+                results[f'{da_mode}_estimate'], results[f'{da_mode}_mean'], results[f'{da_mode}_spread'],
+                results[f'{da_mode}_quantiles'], results[f'{da_mode}_quantile_levels'])
+
+    if not show:
+        lorenz_plotting.plot_da_results_parallel(settings, results['base_run'], results['mod_run'], observations,
+                                                 statistics_by_mode, results['t_array'], decimate)
+        return
+
+    for da_mode, statistics in statistics_by_mode.items():
+        lorenz_plotting.plot_da_result(settings, results['base_run'], results['mod_run'], observations,
+                                       statistics, results['t_array'], da_mode, show, decimate)
+
+
+def run_assimilation(settings, args):
+    """Run the experiment of the assimilate command (or the complete workflow), writing any requested profiles"""
 
-    logging.info('Beginning perfect model run')
-    t_array                                         = lorenz_array_prep.create_time_array(settings)
-    rho_base_array, psi_base_array, beta_base_array = lorenz_array_prep.create_parameter_arrays(settings, 'base')
-    rho_mod_array, psi_mod_array, beta_mod_array    = lorenz_array_prep.create_parameter_arrays(settings, 'mod')
+    if args.seed is not None:
+        settings['seed'] = args.seed
+
+    profilers = {da_mode: instrumentation.Profiler() for da_mode in DA_MODES} if args.profile else {}
+    results = run_experiment(settings, profilers, args.resume, getattr(args, 'store', None))
+
+    for da_mode, profiler in profilers.items():
+        if settings[f'run_{da_mode}'] == True:
+            profiler.to_json(f'{da_mode}_profile.json')
+
+    return results
+
+
+def run_online(settings, args):
+    """Run the online command, saving the statistics and latencies of the run"""
+
+    import asyncio
+    from scripts import online, sweep
+
+    if args.seed is not None:
+        settings['seed'] = args.seed
+
+    t_array = lorenz_array_prep.create_time_array(settings)
+    parameter_rng, filter_rngs = experiment_generators(settings)
+    params = lorenz_array_prep.create_ens_arrays(settings, parameter_rng)
 
+    if args.file is not None:
+        source = online.file_source(args.file)
+    else:
+        source = online.socket_source(port=args.port)
 
-    logging.info(f'First performing base model run.')
-    state_array_base_run = run_lorenz_deterministic(rho_base_array, psi_base_array, beta_base_array,
-                                      settings['u_ini_base'],settings['v_ini_base'],settings['w_ini_base'],
-                                      t_array, settings['delta_t'])
+    statistics, latency = asyncio.run(online.assimilate_online(settings, params, t_array, args.mode, source,
+                                                               filter_rngs[args.mode], max_wait=args.max_wait))
 
-    logging.info('Plot 3D result')
-    #lorenz_plotting.plot_3D_lorenz(settings,state_array_base_run)
+    sweep.save_result(args.output, {'t_array': t_array,
+                                    f'{args.mode}_estimate': statistics.estimate,
+                                    f'{args.mode}_mean': statistics.mean,
+                                    f'{args.mode}_spread': statistics.spread,
+                                    f'{args.mode}_quantiles': statistics.quantiles,
+                                    'latency': latency}, settings)
 
-    logging.info('Plot variable comparison result')
-    #lorenz_plotting.plot_lorenz_basis(state_array_base_run)
 
-    logging.info('Second performing modified model run, to be used as pseudo-measurements')
-    state_array_mod_run = run_lorenz_deterministic(rho_mod_array, psi_mod_array, beta_mod_array,
-                                     settings['u_ini_mod'],settings['v_ini_mod'],settings['w_ini_mod'],
-                                     t_array, settings['delta_t'])
+def main(argv=None):
+    """Command line entry point"""
 
-    logging.info('Create ensemble of arrays, based on prescribed parameter variance')
-    rho_ens_array, psi_ens_array, beta_ens_array = lorenz_array_prep.create_ens_arrays(settings)
+    from scripts import sweep
 
+    parser = argparse.ArgumentParser(description='Lorenz system data assimilation')
+    parser.add_argument('--settings', default='settings.ini', help='Settings file')
+    parser.add_argument('--seed', type=int, help='Seed of all random draws, overriding the settings file')
+    parser.add_argument('--profile', action='store_true', help='Write the {da_mode}_profile.json run profiles')
+    parser.add_argument('--show', action='store_true', help='Show the figures in a window, as well as saving them')
+    parser.add_argument('--full-resolution', action='store_true',
+                        help='Draw every timestep, rather than decimating the series to the figure width')
+    parser.add_argument('--resume', action='store_true', help='Continue each filter run from its latest checkpoint')
+    subparsers = parser.add_subparsers(dest='command')
 
-    logging.info('Generating measurements at the desired frequency')
-    meas_array = lorenz_array_prep.create_measurement_array(settings, state_array_base_run[0][:])
+    truth_parser = subparsers.add_parser('truth', help='Base and modified deterministic runs, with observations')
+    truth_parser.add_argument('--output', default='truth.npz')
 
-    if settings['run_pf'] == True:
-        pf_ens_states, pf_est_states = run_lorenz_ensemble(settings, rho_ens_array, psi_ens_array, beta_ens_array,
-                                                                       t_array, da_mode = 'pf')
+    assimilate_parser = subparsers.add_parser('assimilate', help='Headless data assimilation run')
+    assimilate_parser.add_argument('--mode', choices=[*DA_MODES, 'both'],
+                                   help='Filters to run, by default run_pf and run_enkf from the settings')
+    assimilate_parser.add_argument('--output', default='results.npz')
+    assimilate_parser.add_argument('--store', help='Also stream the full ensemble of each filter into a trajectory '
+                                                   'store in this directory')
 
-        lorenz_plotting.plot_da_result(settings,state_array_base_run,state_array_mod_run,meas_array,
-                                       pf_ens_states, pf_est_states,t_array,da_mode = 'pf')
+    plot_parser = subparsers.add_parser('plot', help='Plot saved assimilate results')
+    plot_parser.add_argument('results', nargs='?', default='results.npz')
 
-    if settings['run_enkf'] == True:
-        enkf_ens_states, enkf_est_states = run_lorenz_ensemble(settings, rho_ens_array, psi_ens_array, beta_ens_array,
-                                                                       t_array, da_mode = 'enkf')
+    sweep_parser = subparsers.add_parser('sweep', help='Cached parallel sweep over a grid of settings')
+    sweep_parser.add_argument('grid', nargs='+', help='key=value1,value2 for each swept setting')
+    sweep_parser.add_argument('--cache-dir', default='sweep_cache')
+    sweep_parser.add_argument('--workers', type=int)
 
-        lorenz_plotting.plot_da_result(settings,state_array_base_run,state_array_mod_run,meas_array,
-                                       enkf_ens_states, enkf_est_states,t_array,da_mode = 'enkf')
+    online_parser = subparsers.add_parser('online', help='Assimilate observations as they arrive')
+    online_parser.add_argument('--mode', choices=DA_MODES, default='pf')
+    online_source = online_parser.add_mutually_exclusive_group(required=True)
+    online_source.add_argument('--file', help='Tail json line observations appended to this file')
+    online_source.add_argument('--port', type=int, help='Receive json line observations on this local TCP port')
+    online_parser.add_argument('--max-wait', type=float,
+                               help='Seconds to wait for an observation before skipping its analysis')
+    online_parser.add_argument('--output', default='online_results.npz')
 
+    args = parser.parse_args(argv)
 
+    if args.command == 'plot':
+        results = sweep.load_result(args.results)
+        plot_results(results, results['settings'], args.show, not args.full_resolution)
+        return
 
+    if args.command == 'sweep':
+        grid = dict(parse_override(text) for text in args.grid)
+        seed = args.seed if args.seed is not None else 0
+        for path in sweep.run_sweep(sweep.expand_grid(grid), args.settings, args.cache_dir, args.workers, seed):
+            print(path)
+        return
 
+    logging.info('Read settings from settings file.')
+    settings = utils.read_settings(args.settings)
+
+    if args.command == 'truth':
+        if args.seed is not None:
+            settings['seed'] = args.seed
+        t_array, state_array_base_run, state_array_mod_run, observations = run_truth_and_observations(settings)
+        sweep.save_result(args.output, {'t_array': t_array,
+                                        'base_run': state_array_base_run,
+                                        'mod_run': state_array_mod_run,
+                                        'observation_index': observations.index,
+                                        'observation_values': observations.values,
+                                        'observation_variance': observations.variance}, settings)
+        return
+
+    if args.command == 'online':
+        run_online(settings, args)
+        return
+
+    if args.command == 'assimilate':
+        if args.mode is not None:
+            settings['run_pf'] = args.mode in ('pf', 'both')
+            settings['run_enkf'] = args.mode in ('enkf', 'both')
+        sweep.save_result(args.output, run_assimilation(settings, args), settings)
+        return
+
+    #Complete workflow: truth, filters and figures
+    plot_results(run_assimilation(settings, args), settings, args.show, not args.full_resolution)
+
+
+if __name__ == '__main__':
+    main()
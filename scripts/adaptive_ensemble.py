@@ -0,0 +1,98 @@
+"""
+
+Lorenz Data Assimilation
+
+Adaptive ensemble size, grown when the particle weights or the ensemble spread collapse and shrunk while the filter
+is well conditioned
+
+At each analysis the ensemble is diagnosed from the effective sample fraction n_eff / nens of the particle filter
+and the spread ratio of the forecast, (ensemble variance + observation error variance) / squared innovation of the
+ensemble mean in observation space. The spread ratio is about one for an ensemble whose spread matches its error
+and falls towards zero once the spread has collapsed. The ensemble is grown by ens_resize_factor if either
+diagnostic is below its low threshold, and shrunk by it once every diagnostic has been above its high threshold for
+adapt_patience consecutive analyses, within min_ens and max_ens. Growing at once and shrinking slowly keeps a
+single noisy innovation from collapsing a small ensemble, which resampling cannot recover. The ensemble is resized
+by resampling, see resize_ensemble.
+
+Scripted by dave.casson@usask.ca
+
+"""
+
+import numpy as np
+
+from . import particle_filter as pf
+
+
+def check_settings(settings):
+    """Validate the adaptive ensemble settings, which need the serial backend as the sharded ensemble is allocated
+    once in shared memory"""
+
+    if not settings['adaptive_ensemble']:
+        return
+
+    if settings['backend'] != 'serial':
+        raise ValueError('The adaptive ensemble size needs the serial backend')
+    if not 2 <= settings['min_ens'] <= settings['num_ens'] <= settings['max_ens']:
+        raise ValueError(f'The ensemble size bounds need 2 <= min_ens <= num_ens <= max_ens, '
+                         f'got {settings["min_ens"]}, {settings["num_ens"]} and {settings["max_ens"]}')
+    if settings['ens_resize_factor'] <= 1:
+        raise ValueError('ens_resize_factor must be greater than one')
+
+
+def ensemble_capacity(settings):
+    """Largest ensemble size of a run, max_ens with an adaptive ensemble, otherwise num_ens.
+    Stores of the full ensemble are allocated with this many members, the members beyond the current size are NaN"""
+    return settings['max_ens'] if settings['adaptive_ensemble'] else settings['num_ens']
+
+
+def spread_ratio(state_array, z, H, variance):
+    """Spread ratio of the forecast ensemble (nstate x nens) at the observation z, (mean ensemble variance +
+    observation error variance) / mean squared innovation of the ensemble mean over the observed variables"""
+
+    HX = H @ state_array.astype(np.float64, copy=False)
+    innovation = z - np.mean(HX, axis=1)
+
+    return (np.mean(np.var(HX, axis=1, ddof=1)) + variance) / max(np.mean(innovation ** 2), np.finfo(float).tiny)
+
+
+def target_ensemble_size(settings, num_ens, spread, n_eff_fraction=None, well_conditioned_analyses=0):
+    """Ensemble size after an analysis of an ensemble of num_ens members, from its spread ratio and, for the
+    particle filter, its effective sample fraction. well_conditioned_analyses counts the consecutive well conditioned
+    analyses before this one. Returns the ensemble size and the updated count"""
+
+    collapsed = spread < settings['adapt_spread_low'] or \
+        (n_eff_fraction is not None and n_eff_fraction < settings['adapt_neff_low'])
+    well_conditioned = spread > settings['adapt_spread_high'] and \
+        (n_eff_fraction is None or n_eff_fraction > settings['adapt_neff_high'])
+
+    well_conditioned_analyses = well_conditioned_analyses + 1 if well_conditioned else 0
+
+    if collapsed:
+        num_ens = int(np.ceil(num_ens * settings['ens_resize_factor']))
+    elif well_conditioned_analyses >= settings['adapt_patience']:
+        num_ens = int(np.floor(num_ens / settings['ens_resize_factor']))
+        well_conditioned_analyses = 0
+
+    return int(np.clip(num_ens, settings['min_ens'], settings['max_ens'])), well_conditioned_analyses
+
+
+def resize_ensemble(settings, state_array, params, weights, num_ens, rng):
+    """Resize the ensemble (nstate x nens) and its (nens) parameter arrays to num_ens members
+
+    The members are drawn by weight with the resampling scheme of the settings, with equal weights for the EnKF.
+    Members drawn more than once are perturbed by resize_jitter times the ensemble spread of each variable, so that
+    the copies separate in the forecast. Returns the new state array and parameter arrays, whose weights are equal
+    """
+
+    index = pf.resample_index(settings, weights, rng, num_ens)
+
+    # Every draw of a member after its first is a duplicate
+    duplicates = np.ones(num_ens, dtype=bool)
+    duplicates[np.unique(index, return_index=True)[1]] = False
+
+    spread = np.std(state_array, axis=1, dtype=np.float64, keepdims=True)
+    state_array = state_array[:, index]
+    state_array[:, duplicates] += (settings['resize_jitter'] * spread *
+                                   rng.standard_normal((len(state_array), np.count_nonzero(duplicates))))
+
+    return state_array, tuple(param[index] for param in params)
@@ -0,0 +1,377 @@
+"""
+
+Lorenz Data Assimilation
+
+Benchmark suite for the deterministic run, ensemble forecast, particle filter, EnKF, LETKF and plotting stages.
+The forecast runs Lorenz-63, and Lorenz-96 for the other state dimensions.
+The forecast and particle filter stages also run in each requested ensemble dtype. Their error_vs_float64 is the
+relative difference from float64: of the final ensemble for the forecast, of the log likelihoods for pf_likelihood,
+and of the estimate RMSE against the truth for a complete particle filter run (pf_run)
+
+Run from the repository root, e.g.
+    python -m scripts.benchmark --output bench.json --save-baseline benchmark_baseline.json
+    python -m scripts.benchmark --output bench.json --baseline benchmark_baseline.json
+
+Scripted by dave.casson@usask.ca
+
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from . import utilities as utils
+from . import lorenz_array_prep
+from . import ensemble_forecast
+from . import models
+from . import integrators
+from . import particle_filter as pf
+from . import ensemble_kalman_filter as enkf
+from . import ensemble_statistics
+
+
+def measure(function, repeats):
+    """Best wall time over repeats calls of function, and the peak memory allocated during one call"""
+
+    tracemalloc.start()
+    function()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    seconds = []
+    for repeat in range(repeats):
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+
+    return min(seconds), peak_memory
+
+
+def result_record(stage, num_ens, num_timesteps, n_state, member_steps, seconds, peak_memory, dtype='float64',
+                  error_vs_float64=0.):
+    """One benchmark result, with the throughput in member-steps per second"""
+
+    return {'stage': stage, 'num_ens': num_ens, 'num_timesteps': num_timesteps, 'n_state': n_state,
+            'dtype': dtype, 'seconds': seconds, 'member_steps_per_second': member_steps / seconds,
+            'peak_memory_bytes': peak_memory, 'error_vs_float64': error_vs_float64}
+
+
+def relative_error(values, reference):
+    """Largest absolute difference from the reference, relative to its largest magnitude"""
+    return float(np.max(np.abs(np.asarray(values, dtype=float) - reference)) / np.max(np.abs(reference)))
+
+
+def synthetic_ensemble(n_state, num_ens, rng):
+    """Random ensemble (nstate x nens) with every variable observed, for the filter stages"""
+
+    state_array = rng.normal(scale=5., size=(n_state, num_ens))
+    H = np.eye(n_state)
+    z = rng.normal(scale=5., size=n_state)
+
+    return state_array, H, z
+
+
+def benchmark_deterministic(settings, num_timesteps, repeats):
+    """Time run_lorenz_deterministic over num_timesteps"""
+
+    #The top level script is outside the scripts package, so it is only imported by the stages that run it
+    import lorenz_data_assimilation as lda
+
+    settings = dict(settings, num_timesteps=num_timesteps)
+    t_array = lorenz_array_prep.create_time_array(settings)
+    rho_array, psi_array, beta_array = lorenz_array_prep.create_parameter_arrays(settings, 'base')
+
+    seconds, peak_memory = measure(lambda: lda.run_lorenz_deterministic(
+        rho_array, psi_array, beta_array, settings['u_ini_base'], settings['v_ini_base'], settings['w_ini_base'],
+        t_array, settings['delta_t'], settings['integrator'], settings['n_substeps'], settings['rtol'],
+        settings['atol']), repeats)
+
+    return result_record('deterministic', 1, num_timesteps, 3, num_timesteps, seconds, peak_memory)
+
+
+def forecast_function(settings, num_timesteps):
+    """Ensemble forecast over num_timesteps from the modified initial state, returning the final ensemble"""
+
+    model = models.get_model(settings)
+    dtype = ensemble_forecast.ensemble_dtype(settings)
+
+    params = tuple(np.abs(param).astype(dtype)
+                   for param in lorenz_array_prep.create_ens_arrays(settings, np.random.default_rng(0)))
+    advance = integrators.create_stepper_from_settings(settings, model.tendency)
+
+    def forecast():
+        state_array, derivative_array = ensemble_forecast.initialize_ensemble(settings,
+                                                                              model.initial_state(settings, 'mod'))
+        model.tendency(state_array, *params, out=derivative_array)
+        for i in range(num_timesteps):
+            advance(state_array, derivative_array, params)
+        return state_array
+
+    return forecast
+
+
+def benchmark_forecast(settings, num_ens, num_timesteps, repeats, n_state=3, dtype='float64'):
+    """Time the ensemble forecast alone, advancing num_ens members over num_timesteps
+
+    A state dimension n_state other than 3 forecasts Lorenz-96 with l96_dimension n_state, see models
+    """
+
+    settings = dict(settings, num_ens=num_ens, dtype=dtype)
+    if n_state != 3:
+        settings.update(model='lorenz96', l96_dimension=n_state)
+
+    forecast = forecast_function(settings, num_timesteps)
+    seconds, peak_memory = measure(forecast, repeats)
+
+    error = 0.
+    if dtype != 'float64':
+        error = relative_error(forecast(), forecast_function(dict(settings, dtype='float64'), num_timesteps)())
+
+    return result_record('forecast', num_ens, num_timesteps, n_state, num_ens * num_timesteps, seconds, peak_memory,
+                         dtype, error)
+
+
+def benchmark_particle_filter(settings, num_ens, n_state, repeats, dtype='float64'):
+    """Time one likelihood evaluation and one resampling of the particle filter, on an ensemble of type dtype"""
+
+    rng = np.random.default_rng(0)
+    state_array, H, z = synthetic_ensemble(n_state, num_ens, rng)
+    reference_log_likelihoods = pf.calculate_log_likelihoods(settings, state_array, z, H)
+
+    state_array = state_array.astype(dtype)
+    log_likelihoods = pf.calculate_log_likelihoods(settings, state_array, z, H)
+    weights = np.exp(pf.normalize_log_weights(log_likelihoods))
+    error = relative_error(log_likelihoods, reference_log_likelihoods)
+
+    likelihood_seconds, likelihood_memory = measure(
+        lambda: pf.normalize_log_weights(pf.calculate_log_likelihoods(settings, state_array, z, H)), repeats)
+    resample_seconds, resample_memory = measure(lambda: pf.resample(settings, state_array, weights, rng), repeats)
+
+    return [result_record('pf_likelihood', num_ens, 1, n_state, num_ens, likelihood_seconds, likelihood_memory,
+                          dtype, error),
+            result_record('pf_resample', num_ens, 1, n_state, num_ens, resample_seconds, resample_memory, dtype)]
+
+
+def benchmark_filter_run(settings, num_ens, num_timesteps, repeats, dtype='float64'):
+    """Time a complete particle filter run of num_ens members over num_timesteps, with its estimate RMSE against
+    the truth in estimate_rmse"""
+
+    #The top level script is outside the scripts package, so it is only imported by the stages that run it
+    import lorenz_data_assimilation as lda
+
+    settings = dict(settings, num_ens=num_ens, num_timesteps=num_timesteps, truth_cache_dir='None')
+    t_array, state_array_base_run, _, observations = lda.run_truth_and_observations(settings)
+    params = lorenz_array_prep.create_ens_arrays(settings, np.random.default_rng(0))
+
+    def estimate_rmse(run_dtype):
+        statistics = lda.run_ensemble_statistics(dict(settings, dtype=run_dtype), params, t_array, 'pf',
+                                                 observations, np.random.default_rng(0))
+        return np.sqrt(np.mean((statistics.estimate - state_array_base_run.T) ** 2))
+
+    seconds, peak_memory = measure(lambda: estimate_rmse(dtype), repeats)
+
+    rmse = estimate_rmse(dtype)
+    error = 0.
+    if dtype != 'float64':
+        error = relative_error(rmse, estimate_rmse('float64'))
+
+    result = result_record('pf_run', num_ens, num_timesteps, len(state_array_base_run), num_ens * num_timesteps,
+                           seconds, peak_memory, dtype, error)
+    result['estimate_rmse'] = float(rmse)
+
+    return result
+
+
+def benchmark_enkf(settings, num_ens, n_state, repeats):
+    """Time one EnKF analysis"""
+
+    rng = np.random.default_rng(0)
+    state_array, H, z = synthetic_ensemble(n_state, num_ens, rng)
+    R = lorenz_array_prep.observation_error_variance(settings, n_state)
+
+    seconds, peak_memory = measure(lambda: enkf.update_enkf(settings, state_array, z, H, R, rng), repeats)
+
+    return result_record('enkf_update', num_ens, 1, n_state, num_ens, seconds, peak_memory)
+
+
+def benchmark_letkf(settings, num_ens, n_state, localization_radius, repeats):
+    """Time one LETKF analysis of a Lorenz-96 state of dimension n_state"""
+
+    settings = dict(settings, model='lorenz96', l96_dimension=n_state, enkf_variant='letkf',
+                    localization_radius=localization_radius)
+
+    rng = np.random.default_rng(0)
+    state_array, H, z = synthetic_ensemble(n_state, num_ens, rng)
+    R = lorenz_array_prep.observation_error_variance(settings, n_state)
+
+    seconds, peak_memory = measure(lambda: enkf.update_enkf(settings, state_array, z, H, R, rng), repeats)
+
+    return result_record('letkf_update', num_ens, 1, n_state, num_ens, seconds, peak_memory)
+
+
+def benchmark_plot(settings, num_ens, num_timesteps, repeats, decimate=False):
+    """Time plot_da_result for a run of num_timesteps, writing the figure into a temporary directory"""
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from . import lorenz_plotting
+
+    settings = dict(settings, num_timesteps=num_timesteps)
+    rng = np.random.default_rng(0)
+    t_array = lorenz_array_prep.create_time_array(settings)
+    state_array_run = rng.normal(size=(3, num_timesteps))
+    observations = lorenz_array_prep.create_observations(settings, state_array_run)
+
+    statistics = ensemble_statistics.EnsembleStatistics(num_timesteps)
+    for i in range(num_timesteps):
+        statistics.update(i, state_array_run[:, i], rng.normal(size=(3, num_ens)))
+
+    def plot():
+        lorenz_plotting.plot_da_result(settings, state_array_run, state_array_run, observations, statistics,
+                                       t_array, da_mode='pf', decimate=decimate)
+        plt.close('all')
+
+    working_directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as plot_directory:
+        os.chdir(plot_directory)
+        try:
+            seconds, peak_memory = measure(plot, repeats)
+        finally:
+            os.chdir(working_directory)
+
+    return result_record('plot_decimated' if decimate else 'plot', num_ens, num_timesteps, 3, num_timesteps,
+                         seconds, peak_memory)
+
+
+def run_benchmarks(settings, num_ens_values, num_timesteps_values, n_state_values, repeats=3, plot=True,
+                   localization_radius=4, dtypes=('float64',), letkf_max_ens=1000):
+    """Run every stage over the requested ensemble sizes, run lengths and state dimensions, and the forecast and
+    particle filter stages in each of the ensemble dtypes. The LETKF stage, whose local analyses hold an nens x nens
+    matrix per grid point, is skipped above letkf_max_ens members"""
+
+    results = []
+
+    for num_timesteps in num_timesteps_values:
+        logging.info(f'Benchmarking the deterministic run, {num_timesteps} timesteps')
+        results.append(benchmark_deterministic(settings, num_timesteps, repeats))
+
+        for num_ens in num_ens_values:
+            for dtype in dtypes:
+                logging.info(f'Benchmarking the {dtype} forecast, {num_ens} members and {num_timesteps} timesteps')
+                results.append(benchmark_forecast(settings, num_ens, num_timesteps, repeats, dtype=dtype))
+
+        if plot:
+            logging.info(f'Benchmarking plot_da_result, {num_timesteps} timesteps')
+            results.append(benchmark_plot(settings, min(num_ens_values), num_timesteps, repeats))
+            results.append(benchmark_plot(settings, min(num_ens_values), num_timesteps, repeats, decimate=True))
+
+    for n_state in n_state_values:
+        for num_ens in num_ens_values:
+            if n_state != 3:
+                logging.info(f'Benchmarking the Lorenz-96 forecast, {num_ens} members and state dimension {n_state}')
+                results.append(benchmark_forecast(settings, num_ens, min(num_timesteps_values), repeats, n_state))
+
+            logging.info(f'Benchmarking the filters, {num_ens} members and state dimension {n_state}')
+            for dtype in dtypes:
+                results.extend(benchmark_particle_filter(settings, num_ens, n_state, repeats, dtype))
+            results.append(benchmark_enkf(settings, num_ens, n_state, repeats))
+            if n_state != 3:
+                if num_ens <= letkf_max_ens:
+                    results.append(benchmark_letkf(settings, num_ens, n_state, localization_radius, repeats))
+                else:
+                    logging.info(f'Skipping the LETKF with {num_ens} members, above --letkf-max-ens {letkf_max_ens}')
+
+    for num_ens in num_ens_values:
+        for dtype in dtypes:
+            logging.info(f'Benchmarking a {dtype} particle filter run, {num_ens} members')
+            results.append(benchmark_filter_run(settings, num_ens, min(num_timesteps_values), repeats, dtype))
+
+    return results
+
+
+def benchmark_key(result):
+    return (result['stage'], result['num_ens'], result['num_timesteps'], result['n_state'],
+            result.get('dtype', 'float64'))
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Compare throughput against a baseline, returning the results that are slower by more than tolerance"""
+
+    baseline_results = {benchmark_key(result): result for result in baseline}
+
+    regressions = []
+    for result in results:
+        reference = baseline_results.get(benchmark_key(result))
+        if reference is None:
+            continue
+
+        ratio = result['member_steps_per_second'] / reference['member_steps_per_second']
+        result['baseline_ratio'] = ratio
+        if ratio < 1 - tolerance:
+            regressions.append(result)
+
+    return regressions
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Benchmark the Lorenz data assimilation stages')
+    parser.add_argument('--settings', default='settings.ini')
+    parser.add_argument('--num-ens', type=int, nargs='+', default=[10, 100, 1000, 10000, 100000])
+    parser.add_argument('--num-timesteps', type=int, nargs='+', default=[100, 1000])
+    parser.add_argument('--n-state', type=int, nargs='+', default=[3, 40, 400])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--dtype', nargs='+', default=['float64', 'float32'], choices=['float64', 'float32'],
+                        help='Ensemble dtypes of the forecast and particle filter stages')
+    parser.add_argument('--localization-radius', type=float, default=4,
+                        help='Localization radius of the LETKF stage, in grid points')
+    parser.add_argument('--letkf-max-ens', type=int, default=1000,
+                        help='Largest ensemble size of the LETKF stage, whose memory grows with nens squared')
+    parser.add_argument('--no-plot', action='store_true', help='Skip the plot_da_result stage')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', help='Baseline results to compare against')
+    parser.add_argument('--save-baseline', help='Also write the results as a new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Flag a regression when throughput falls by more than this fraction')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    settings = utils.read_settings(args.settings)
+
+    results = run_benchmarks(settings, args.num_ens, args.num_timesteps, args.n_state, args.repeats,
+                             not args.no_plot, args.localization_radius, args.dtype, args.letkf_max_ens)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare_to_baseline(results, json.load(baseline_file), args.tolerance)
+
+    for result in results:
+        ratio = f"  x{result['baseline_ratio']:.2f} of baseline" if 'baseline_ratio' in result else ''
+        print(f"{result['stage']:14s} nens={result['num_ens']:<7d} nt={result['num_timesteps']:<6d} "
+              f"nstate={result['n_state']:<5d} {result['dtype']:8s} {result['member_steps_per_second']:12.4g} "
+              f"member-steps/s {result['peak_memory_bytes'] / 1e6:10.2f} MB "
+              f"error {result['error_vs_float64']:8.2e}{ratio}")
+
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+
+    for result in regressions:
+        logging.warning(f"Regression in {benchmark_key(result)}: {result['baseline_ratio']:.2f} of baseline throughput")
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
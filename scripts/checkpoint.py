@@ -0,0 +1,88 @@
+"""
+
+Lorenz Data Assimilation
+
+Checkpoints of an ensemble run, so that a long run can be resumed after its process is lost
+
+Scripted by dave.casson@usask.ca
+
+"""
+
+import json
+import logging
+import os
+
+import numpy as np
+
+from .sweep import settings_hash
+from .utilities import atomic_savez
+
+# Settings that do not change the result of a run, and may differ between a run and its resumption. The store
+# settings only set the layout of the trajectory store written alongside the run (see trajectory_store)
+RESUMABLE_SETTINGS = ('checkpoint_interval', 'checkpoint_path', 'store_compression', 'store_chunk_size',
+                      'truth_cache_dir', 'truth_cache_max_mb')
+
+
+def checkpoint_path(settings, da_mode):
+    """Checkpoint file of a run, settings['checkpoint_path'] with the da_mode added e.g. checkpoint_pf.npz"""
+
+    root, extension = os.path.splitext(settings['checkpoint_path'])
+    return f'{root}_{da_mode}{extension or ".npz"}'
+
+
+def run_hash(settings, da_mode):
+    """Hash identifying the run a checkpoint belongs to"""
+
+    run_settings = {key: value for key, value in settings.items() if key not in RESUMABLE_SETTINGS}
+    return settings_hash(dict(run_settings, da_mode=str(da_mode)))
+
+
+def to_json(value):
+    """Serialize generator states, which may hold numpy arrays, as json text"""
+    return json.dumps(value, default=lambda item: item.tolist())
+
+
+def save_checkpoint(path, settings, da_mode, step, arrays, generator_states):
+    """Write the checkpoint of timestep step as an uncompressed .npz
+
+    arrays are the ensemble state, derivative, parameters and weights, and the accumulated results of the run.
+    generator_states holds the random generator and integrator states (e.g. the adaptive step size), stored as json
+    """
+
+    checkpoint_arrays = dict(arrays,
+                             step=np.array(step),
+                             run_hash=np.array(run_hash(settings, da_mode)),
+                             generator_states=np.array(to_json(generator_states)))
+
+    #An interrupted write never replaces the last good checkpoint
+    atomic_savez(path, **checkpoint_arrays)
+
+
+def load_checkpoint(path, settings, da_mode):
+    """Load the checkpoint of a run, or return None if there is none. Returns a dictionary of the saved arrays,
+    with the integer step and the generator_states
+
+    Raises ValueError if the checkpoint was written by a run with different settings
+    """
+
+    if not os.path.exists(path):
+        return None
+
+    with np.load(path) as data:
+        checkpoint = {key: data[key] for key in data.files}
+
+    if str(checkpoint.pop('run_hash')) != run_hash(settings, da_mode):
+        raise ValueError(f'Checkpoint {path} was written by a run with different settings')
+
+    checkpoint['step'] = int(checkpoint['step'])
+    checkpoint['generator_states'] = json.loads(str(checkpoint['generator_states']))
+    logging.info(f'Resuming the {da_mode} run from timestep {checkpoint["step"]} of checkpoint {path}')
+
+    return checkpoint
+
+
+def restore_generator(rng, generator_state):
+    """Return rng to a state saved with rng.bit_generator.state"""
+
+    rng.bit_generator.state = generator_state
+    return rng
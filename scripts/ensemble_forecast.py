@@ -0,0 +1,100 @@
+"""
+
+Lorenz Data Assimilation
+
+Vectorized ensemble forecast engine
+
+Scripted by dave.casson@usask.ca
+
+"""
+
+import numpy as np
+
+# Floating point types of the ensemble arrays
+ENSEMBLE_DTYPES = ('float64', 'float32')
+
+
+def ensemble_dtype(settings):
+    """Floating point type of the ensemble state, parameters and results, settings['dtype'] (float64 if absent)
+
+    float32 halves the memory traffic of large ensembles. Reductions over the members (weights, estimates,
+    statistics and the EnKF analysis) are still accumulated in float64
+    """
+
+    name = settings.get('dtype', 'float64')
+    if name not in ENSEMBLE_DTYPES:
+        raise ValueError(f'Unknown dtype {name}, use {", ".join(ENSEMBLE_DTYPES)}')
+
+    return np.dtype(name)
+
+
+def initialize_ensemble(settings, initial_state=None):
+    """Create the (nstate x nens) state and derivative arrays, with every member starting from initial_state (nstate),
+    by default the modified initial conditions of Lorenz-63 (see models.Model.initial_state).
+    The arrays have the ensemble_dtype of the settings"""
+
+    if initial_state is None:
+        initial_state = [settings['u_ini_mod'], settings['v_ini_mod'], settings['w_ini_mod']]
+    dtype = ensemble_dtype(settings)
+
+    state_array = np.empty((len(initial_state), settings['num_ens']), dtype=dtype)
+    state_array[:] = np.reshape(initial_state, (-1, 1))
+
+    derivative_array = np.zeros((len(initial_state), settings['num_ens']), dtype=dtype)
+
+    return state_array, derivative_array
+
+
+def derivative_dtype(state_array):
+    """Floating point type of the derivative of a state, that of a float32 or float64 state (float64 for integers),
+    so that the integrator stages of a float32 ensemble stay in float32"""
+    return np.result_type(np.asarray(state_array).dtype, np.float32)
+
+
+def lorenz_derivative(state_array, rho, psi, beta, out=None):
+    """Evaluate the Lorenz equations for every member at once, writing the derivatives into out if given
+
+    state_array is (3 x nens) with per-member parameter arrays (nens), or a single state (3) with scalar parameters
+    """
+
+    if out is None:
+        out = np.empty(np.shape(state_array), dtype=derivative_dtype(state_array))
+
+    #Slices keep the variable dimension, so a single state (3) and an ensemble (3 x nens) are handled alike
+    u, v, w = state_array[0:1], state_array[1:2], state_array[2:3]
+    du_dt, dv_dt, dw_dt = out[0:1], out[1:2], out[2:3]
+
+    np.subtract(v, u, out=du_dt)
+    du_dt *= rho
+
+    np.subtract(psi, w, out=dv_dt)
+    dv_dt *= u
+    dv_dt -= v
+
+    np.multiply(u, v, out=dw_dt)
+    dw_dt -= beta * w
+
+    return out
+
+
+def lorenz96_derivative(state_array, forcing, out=None):
+    """Evaluate the Lorenz-96 equations dx_i/dt = (x_i+1 - x_i-2) x_i-1 - x_i + F on a ring of variables,
+    for every member at once, writing the derivatives into out if given
+
+    state_array is (nstate x nens) with a per-member forcing array (nens), or a single state (nstate) with a
+    scalar forcing
+    """
+
+    if out is None:
+        out = np.empty(np.shape(state_array), dtype=derivative_dtype(state_array))
+
+    #The ring is padded once with its wrapped ends, so the neighbours are slices rather than rolled copies
+    padded = np.concatenate([state_array[-2:], state_array, state_array[:1]])
+    x_plus_1, x_minus_2, x_minus_1 = padded[3:], padded[:-3], padded[1:-2]
+
+    np.subtract(x_plus_1, x_minus_2, out=out)
+    out *= x_minus_1
+    out -= state_array
+    out += forcing
+
+    return out
@@ -1,4 +1,3 @@
-
 """
 
 Ensemble Kalman Filter
@@ -12,66 +11,308 @@ Scripting by Dave Casson, dave.casson@usask.ca
 
 
 import numpy as np
-from numpy import zeros, array, eye, dot
 import logging
 
-from .utilities import outer_product_sum
+from .utilities import cholesky_solve
+from .lorenz_array_prep import observation_operator, observation_error_variance
+from .models import get_model
 logging.basicConfig(level=logging.INFO)
 
-def hx(x):
-    """ Not currently used
-    Observation Operator that converts modelled states to measurement space
-        In the simplest case, this is an equivalency"""
-    H   = np.array([1,0,0])
-    x_h = np.multiply(x,H)
+def select_solver(settings, nobs, nens):
+    """Choose where the gain is solved: 'state' solves the (nobs x nobs) innovation covariance of the
+        state-space gain, 'ensemble' solves the (nens x nens) ensemble-space system.
+        With settings['enkf_solver'] = auto the smaller of the two is used"""
+
+    if settings['enkf_solver'] == 'auto':
+        return 'state' if nobs <= nens else 'ensemble'
+
+    return settings['enkf_solver']
 
-    return x_h
+def observation_error_noise(R, perturbations):
+    """Noise (nobs x nens) drawn from R, for the standard normal perturbations
 
-def update_enkf(settings, X_b_input, z):
+    R is the observation error covariance (nobs x nobs), or its diagonal (nobs) for independent errors, which is
+    never formed as a matrix. The same holds for the other observation error functions
     """
 
-    X_b_input => Background matrix of states (nstate x nens)
-    z   => Measurement array (nobs)
+    if np.ndim(R) == 1:
+        return np.sqrt(R)[:, np.newaxis] * perturbations
 
-    X_b_mean => Background state mean (nstate)
-    X_b_anol => Background anomalies (nstate x nens)
+    return np.linalg.cholesky(R) @ perturbations
 
-    P_b = Model Error Covariance
+def solve_observation_error(R, B):
+    """R^-1 B, by scaling with the inverse variances for a diagonal R"""
 
-    H => Observation Operator (nstate)
-    R => Observation Error Covariance Matrix (nobs, nobs)
+    if np.ndim(R) == 1:
+        return B / R[:, np.newaxis]
 
-    X_a = Updated state matrix (nstate x nens)
+    return cholesky_solve(R, B)
+
+def add_observation_error(S, R):
+    """S + R for an (nobs x nobs) matrix S, which is updated in place"""
+
+    if np.ndim(R) == 1:
+        S[np.diag_indices_from(S)] += R
+    else:
+        S += R
+
+    return S
+
+def gaspari_cohn(distance, radius):
+    """Gaspari-Cohn fifth order piecewise rational correlation function, tapering from 1 at distance zero
+        to 0 at twice the localization radius"""
+
+    r = np.abs(np.asarray(distance, dtype=float)) / radius
+    taper = np.zeros(np.shape(r))
+
+    near = r <= 1
+    r_near = r[near]
+    taper[near] = -r_near**5 / 4 + r_near**4 / 2 + 5 * r_near**3 / 8 - 5 * r_near**2 / 3 + 1
+
+    far = (r > 1) & (r < 2)
+    r_far = r[far]
+    taper[far] = r_far**5 / 12 - r_far**4 / 2 + 5 * r_far**3 / 8 + 5 * r_far**2 / 3 - 5 * r_far + 4 - 2 / (3 * r_far)
+
+    return taper
+
+def observation_locations(H):
+    """State variable observed by each row of the observation operator H (nobs x nstate), its first non-zero column"""
+    return np.argmax(H != 0, axis=1)
+
+def localization_taper(settings, rows, locations):
+    """Gaspari-Cohn taper (nrows x nobs) between the state variables rows and the observations at locations (see
+        observation_locations), by the model distance and settings['localization_radius']. Rows beyond the model
+        state (augmented parameters) are not localized"""
+
+    model = get_model(settings)
+    rows = np.asarray(rows)
+
+    taper = gaspari_cohn(model.distance(settings, rows[:, np.newaxis], locations),
+                         settings['localization_radius'])
+    taper[rows >= model.n_state(settings)] = 1.
+
+    return taper
+
+def observation_taper(settings, locations):
+    """Gaspari-Cohn taper (nobs x nobs) between the observations at locations"""
+
+    return gaspari_cohn(get_model(settings).distance(settings, locations[:, np.newaxis], locations),
+                        settings['localization_radius'])
+
+def perturbed_innovations(z, HX_b, R, rng, perturbations=None):
+    """Innovations (nobs x nens) of every member against its own copy of the measurements z, perturbed with noise
+    drawn from R. perturbations are standard normal draws (nobs x nens), drawn from rng if not given"""
+
+    if perturbations is None:
+        perturbations = rng.standard_normal(np.shape(HX_b))
+    D = z[:, np.newaxis] + observation_error_noise(R, perturbations)
+
+    return D - HX_b
+
+def perturbed_observation_update(settings, X_b_anol, HX_b, HX_b_anol, z, R, rng, perturbations=None,
+                                 localization=None):
+    """Stochastic EnKF, each member is updated towards its own perturbed copy of the measurements
+
+    perturbations are standard normal draws (nobs x nens), drawn from rng if not given
+    localization is the (nstate x nobs) and (nobs x nobs) Gaspari-Cohn tapers of the state-observation and
+    observation-observation covariances, applied as Schur products to the state-space gain, or None
+
+    Returns the analysis increment (nstate x nens), so that X_a = X_b + increment
     """
 
-    #Add run specific settings
-    N = settings['num_ens']
-    dim_z = 1
-    R_array = np.eye(dim_z) * settings['measurement_var']
-    H = np.array([1, 0, 0])
-    H_T = np.transpose(H)
+    nobs, N = np.shape(HX_b)
+
+    #Perturb the measurements with noise drawn from R, then calculate the innovation of every member
+    innovations = perturbed_innovations(z, HX_b, R, rng, perturbations)
+
+    if localization is not None:
+        # K = (rho_xo o X_b_anol HX_b_anol^T) (rho_oo o HX_b_anol HX_b_anol^T + (N-1) R)^-1, which is only
+        # defined in state space
+        state_taper, obs_taper = localization
+        S = add_observation_error(obs_taper * (HX_b_anol @ HX_b_anol.T), (N - 1) * R)
+        increment = (state_taper * (X_b_anol @ HX_b_anol.T)) @ cholesky_solve(S, innovations)
+    elif select_solver(settings, nobs, N) == 'state':
+        # K = X_b_anol HX_b_anol^T (HX_b_anol HX_b_anol^T + (N-1) R)^-1, formed as (nstate x nobs)
+        S = add_observation_error(HX_b_anol @ HX_b_anol.T, (N - 1) * R)
+        increment = (X_b_anol @ HX_b_anol.T) @ cholesky_solve(S, innovations)
+    else:
+        # Equivalent by the Woodbury identity: (HX_b_anol^T R^-1 HX_b_anol + (N-1) I)^-1 HX_b_anol^T R^-1
+        R_inv_HX_b_anol = solve_observation_error(R, HX_b_anol)
+        C = HX_b_anol.T @ R_inv_HX_b_anol + (N - 1) * np.eye(N)
+        increment = X_b_anol @ cholesky_solve(C, R_inv_HX_b_anol.T @ innovations)
+
+    return increment
+
+def perturbed_observation_weights(settings, HX_b, HX_b_anol, z, R, rng, perturbations=None):
+    """Ensemble-space form of the global perturbed_observation_update, returning the weights W (nens x nens) so
+    that X_a = X_b_mean + X_b_anol W"""
+
+    nobs, N = np.shape(HX_b)
+    innovations = perturbed_innovations(z, HX_b, R, rng, perturbations)
 
-    X_b = np.transpose(X_b_input)
-    X_b_anol = zeros(np.shape(X_b))
-    X_a = zeros(np.shape(X_b))
+    if select_solver(settings, nobs, N) == 'state':
+        S = add_observation_error(HX_b_anol @ HX_b_anol.T, (N - 1) * R)
+        increment_weights = HX_b_anol.T @ cholesky_solve(S, innovations)
+    else:
+        R_inv_HX_b_anol = solve_observation_error(R, HX_b_anol)
+        C = HX_b_anol.T @ R_inv_HX_b_anol + (N - 1) * np.eye(N)
+        increment_weights = cholesky_solve(C, R_inv_HX_b_anol.T @ innovations)
 
-    X_b_mean = np.mean(X_b, axis=0)
+    return np.eye(N) + increment_weights
 
-    for i in range(N):
-        X_b_anol[i] = X_b[i] - X_b_mean
+def ensemble_transform(W):
+    """Ensemble transform T (... x nens x nens) of the weights W, so that X_b T = X_b_mean + X_b_anol W.
+    The analysis is a linear combination of the background members, which the smoother applies to earlier
+    ensembles"""
+    return W - np.mean(W, axis=-2, keepdims=True) + 1 / np.shape(W)[-1]
 
-    P_b = outer_product_sum(X_b_anol)/(N-1)
+def etkf_update(X_b_anol, HX_b_mean, HX_b_anol, z, R):
+    """Deterministic square-root (ETKF) update, without perturbed measurements
 
-    K = P_b * H_T / (H*P_b*H_T+R_array)
+    Returns the ensemble-space weights W (nens x nens) so that X_a = X_b_mean + X_b_anol W
+    """
+
+    N = np.shape(HX_b_anol)[1]
+
+    R_inv_HX_b_anol = solve_observation_error(R, HX_b_anol)
+    C = HX_b_anol.T @ R_inv_HX_b_anol + (N - 1) * np.eye(N)
+
+    #The eigen-decomposition of C gives both its inverse and the symmetric square root
+    eigenvalues, eigenvectors = np.linalg.eigh(C)
+    P_a_ens = (eigenvectors / eigenvalues) @ eigenvectors.T
+
+    w_mean = P_a_ens @ (R_inv_HX_b_anol.T @ (z - HX_b_mean))
+    W = (eigenvectors * np.sqrt((N - 1) / eigenvalues)) @ eigenvectors.T
+
+    return W + w_mean[:, np.newaxis]
+
+def letkf_update(settings, X_b_mean, X_b_anol, HX_b_mean, HX_b_anol, z, R, H, lagged_states=None):
+    """Local ensemble transform Kalman filter (LETKF), an ETKF analysis of each state variable using only its
+    local observations
+
+    The observations of each variable are those within the Gaspari-Cohn cutoff of settings['localization_radius'],
+    with their inverse error variances tapered by distance (R must be diagonal). The local analyses are independent,
+    and are solved letkf_batch_size variables at a time as stacked (nbatch x nens x nens) systems, the local
+    observations of a batch padded with zero weight to its largest local set.
+    Without localization every variable uses all observations, which gives the global ETKF analysis.
+    lagged_states (nlag x nstate x nens) are updated in place by the local ensemble transform of each variable,
+    see update_enkf
+
+    Returns the analysis X_a (nstate x nens)
+    """
+
+    n_state, N = np.shape(X_b_anol)
+    inverse_variance = 1 / (R if np.ndim(R) == 1 else np.diag(R))
+    innovation = z - HX_b_mean
+    batch_size = settings['letkf_batch_size']
+    locations = observation_locations(H)
+
+    X_a = np.empty((n_state, N))
+    for first in range(0, n_state, batch_size):
+        rows = np.arange(first, min(first + batch_size, n_state))
+
+        if settings['localization_radius'] != 'None':
+            taper = localization_taper(settings, rows, locations)
+            # Indices of the local observations first, in observation order
+            num_local = np.max(np.count_nonzero(taper, axis=1))
+            local = np.argsort(taper == 0, axis=1, kind='stable')[:, :num_local]
+            weights = np.take_along_axis(taper, local, axis=1) * inverse_variance[local]
+        else:
+            local = np.broadcast_to(np.arange(len(z)), (len(rows), len(z)))
+            weights = inverse_variance[local]
+
+        # Local observation anomalies (nbatch x nlocal x nens), weighted by the tapered inverse variances
+        Y = HX_b_anol[local]
+        Y_weighted_T = (Y * weights[:, :, np.newaxis]).transpose(0, 2, 1)
+        C = Y_weighted_T @ Y + (N - 1) * np.eye(N)
+
+        eigenvalues, eigenvectors = np.linalg.eigh(C)
+        eigenvectors_T = eigenvectors.transpose(0, 2, 1)
+        P_a_ens = (eigenvectors / eigenvalues[:, np.newaxis, :]) @ eigenvectors_T
+
+        w_mean = P_a_ens @ (Y_weighted_T @ innovation[local][:, :, np.newaxis])
+        W = (eigenvectors * np.sqrt((N - 1) / eigenvalues)[:, np.newaxis, :]) @ eigenvectors_T + w_mean
+
+        X_a[rows] = X_b_mean[rows, np.newaxis] + (X_b_anol[rows, np.newaxis, :] @ W)[:, 0]
+
+        if lagged_states is not None:
+            # Rows of augmented parameters are not held in the lagged states
+            lagged_rows = rows < np.shape(lagged_states)[1]
+            T = ensemble_transform(W[lagged_rows])
+            lagged_states[:, rows[lagged_rows]] = (lagged_states[:, rows[lagged_rows], np.newaxis, :] @ T)[:, :, 0]
+
+    return X_a
+
+def update_enkf(settings, X_b_input, z, H=None, R=None, rng=None, perturbations=None, lagged_states=None):
+    """
+
+    X_b_input => Background matrix of states (nstate x nens)
+    z   => Measurement array (nobs)
+
+    X_b_mean => Background state mean (nstate)
+    X_b_anol => Background anomalies (nstate x nens)
+
+    H => Observation Operator (nobs x nstate), by default from the u_H, v_H and w_H settings
+    R => Observation Error Covariance Matrix (nobs, nobs), or its diagonal (nobs) for independent errors,
+         by default measurement_var for every observation
+
+    X_a = Updated state matrix (nstate x nens)
+
+    settings['enkf_variant'] selects the perturbed observation EnKF ('perturbed'), the
+    deterministic square-root filter ('etkf') or its local form ('letkf'). rng draws the measurement perturbations,
+    unless the standard normal perturbations (nobs x nens) are given.
+    With settings['localization_radius'] the covariances of the perturbed EnKF are localized by a Gaspari-Cohn
+    taper, and the letkf analyses only use the local observations, see letkf_update
+
+    lagged_states (nlag x nstate x nens) are earlier ensembles of the fixed-lag smoother, updated in place by the
+    ensemble transform T of the analysis (X_a = X_b T), a single matrix multiply per lag. Their rows are the first
+    rows of X_b_input. The localized perturbed EnKF has no ensemble transform, and can not smooth
+    """
+
+    #Add run specific settings
+    z = np.atleast_1d(z)
+    if H is None:
+        H = observation_operator(settings)
+    if R is None:
+        R = observation_error_variance(settings, len(z))
+    if rng is None:
+        rng = np.random.default_rng()
 
-    for i in range(N):
-        X_a[i] = X_b[i] + np.dot(K, z - H*X_b[i])
+    #The analysis is computed in float64, also for a float32 ensemble
+    X_b_mean = np.mean(X_b_input, axis=1, dtype=np.float64)
+    X_b_anol = X_b_input - X_b_mean[:, np.newaxis]
 
-    X_a_mean = np.mean(X_a, axis=0)
+    HX_b = H @ X_b_input
+    HX_b_mean = np.mean(HX_b, axis=1)
+    HX_b_anol = HX_b - HX_b_mean[:, np.newaxis]
 
-    X_a_output = np.transpose(X_a)
-    X_a_mean_output = np.transpose(X_a_mean)
+    localize = settings['localization_radius'] != 'None'
 
-    return X_a_output, X_a_mean_output
+    if settings['enkf_variant'] == 'letkf':
+        X_a = letkf_update(settings, X_b_mean, X_b_anol, HX_b_mean, HX_b_anol, z, R, H, lagged_states)
+    elif settings['enkf_variant'] == 'etkf':
+        if localize:
+            raise ValueError('The global etkf can not be localized, use enkf_variant letkf')
+        W = etkf_update(X_b_anol, HX_b_mean, HX_b_anol, z, R)
+        X_a = X_b_mean[:, np.newaxis] + X_b_anol @ W
+        if lagged_states is not None:
+            lagged_states[:] = lagged_states @ ensemble_transform(W)
+    elif lagged_states is not None:
+        if localize:
+            raise ValueError('The localized perturbed EnKF has no ensemble transform to smooth with, '
+                             'use enkf_variant letkf')
+        W = perturbed_observation_weights(settings, HX_b, HX_b_anol, z, R, rng, perturbations)
+        X_a = X_b_mean[:, np.newaxis] + X_b_anol @ W
+        lagged_states[:] = lagged_states @ ensemble_transform(W)
+    else:
+        localization = None
+        if localize:
+            locations = observation_locations(H)
+            localization = (localization_taper(settings, np.arange(len(X_b_input)), locations),
+                            observation_taper(settings, locations))
+        X_a = X_b_input + perturbed_observation_update(settings, X_b_anol, HX_b, HX_b_anol, z, R, rng, perturbations,
+                                                       localization)
 
+    X_a_mean = np.mean(X_a, axis=1)
 
+    return X_a, X_a_mean
@@ -0,0 +1,70 @@
+"""
+
+Lorenz Data Assimilation
+
+Fixed-lag ensemble Kalman smoother (EnKS), a bounded history of the latest ensembles updated by each EnKF analysis
+
+Scripted by dave.casson@usask.ca
+
+"""
+
+import numpy as np
+
+
+class FixedLagSmoother:
+    """History of the ensembles of the last lag timesteps, held in a preallocated ring buffer (lag x nstate x nens)
+
+    At each analysis the stored ensembles are updated with the ensemble transform of the filter (see
+    ensemble_kalman_filter.update_enkf), so that the ensemble of timestep i is smoothed by the observations up to
+    timestep i + lag. Memory is bounded by the lag, not by the run length.
+    Once a timestep leaves the history its smoothed ensemble is passed to each of the consumers as
+    consumer(i, smoothed_estimate, smoothed_state), e.g. an EnsembleStatistics. flush passes on the remaining
+    timesteps at the end of the run.
+    """
+
+    def __init__(self, lag, n_state, num_ens, dtype=np.float64, consumers=()):
+
+        if lag < 1:
+            raise ValueError(f'The smoother lag must be at least one timestep, got {lag}')
+
+        self.history = np.empty((lag, n_state, num_ens), dtype=dtype)
+        # Timestep held in each slot of the ring buffer, -1 for an empty slot
+        self.steps = np.full(lag, -1)
+        self.consumers = list(consumers)
+
+    def lagged_states(self):
+        """The stored ensembles (nstored x nstate x nens), a view updated in place by the analysis.
+        Slots are filled in order from the first, so the stored ensembles are always the leading slots"""
+        return self.history[:np.count_nonzero(self.steps >= 0)]
+
+    def emit(self, slot):
+        state = self.history[slot]
+        for consumer in self.consumers:
+            consumer(self.steps[slot], np.mean(state, axis=1, dtype=np.float64), state)
+
+    def push(self, i, state_timestep_array):
+        """Store the ensemble (nstate x nens) of timestep i, once it has been analysed, passing on the timestep it
+        replaces"""
+
+        slot = i % len(self.history)
+        if self.steps[slot] >= 0:
+            self.emit(slot)
+
+        self.history[slot] = state_timestep_array
+        self.steps[slot] = i
+
+    def flush(self):
+        """Pass on the stored timesteps in order, emptying the history"""
+
+        for slot in np.argsort(self.steps):
+            if self.steps[slot] >= 0:
+                self.emit(slot)
+        self.steps.fill(-1)
+
+    def get_state(self):
+        """Arrays to checkpoint, restored by set_state"""
+        return {'smoother_history': self.history, 'smoother_steps': self.steps}
+
+    def set_state(self, arrays):
+        self.history[:] = arrays['smoother_history']
+        self.steps[:] = arrays['smoother_steps']
@@ -0,0 +1,63 @@
+"""
+
+Lorenz Data Assimilation
+
+Ensemble statistics accumulated timestep by timestep while the filter runs
+
+Scripted by dave.casson@usask.ca
+
+"""
+
+import numpy as np
+
+
+class EnsembleStatistics:
+    """Per-timestep summaries of an ensemble run: state estimate, ensemble mean, spread and quantiles
+
+    The arrays are allocated once with shape (ntimesteps x nstate), quantiles as (nquantiles x ntimesteps x nstate),
+    and are filled by update as each timestep is produced. The full ensemble history is never kept.
+    """
+
+    def __init__(self, num_timesteps, n_state=3, quantiles=(.05, .95)):
+
+        self.quantile_levels = np.asarray(quantiles, dtype=float)
+
+        self.estimate = np.full((num_timesteps, n_state), np.nan)
+        self.mean = np.full((num_timesteps, n_state), np.nan)
+        self.spread = np.full((num_timesteps, n_state), np.nan)
+        self.quantiles = np.full((len(self.quantile_levels), num_timesteps, n_state), np.nan)
+
+    def update(self, i, state_estimate, state_timestep_array):
+        """Add the summaries of timestep i, from the estimate (nstate) and the ensemble (nstate x nens)"""
+
+        self.estimate[i] = state_estimate
+        #Accumulated in float64, also for a float32 ensemble
+        self.mean[i] = np.mean(state_timestep_array, axis=1, dtype=np.float64)
+        self.spread[i] = np.std(state_timestep_array, axis=1, dtype=np.float64,
+                                ddof=1 if state_timestep_array.shape[1] > 1 else 0)
+        self.quantiles[:, i] = np.quantile(state_timestep_array, self.quantile_levels, axis=1)
+
+    # Allows the statistics to subscribe directly to an ensemble stream
+    __call__ = update
+
+    @classmethod
+    def from_arrays(cls, estimate, mean, spread, quantiles, quantile_levels=(.05, .95)):
+        """Rebuild the statistics from saved arrays, e.g. the {da_mode}_* arrays of run_experiment"""
+
+        statistics = cls(0, 0, quantile_levels)
+        statistics.estimate = np.asarray(estimate)
+        statistics.mean = np.asarray(mean)
+        statistics.spread = np.asarray(spread)
+        statistics.quantiles = np.asarray(quantiles)
+
+        return statistics
+
+    @classmethod
+    def from_ensemble(cls, state_result_array, state_estimate_array, quantiles=(.05, .95)):
+        """Summarize a stored (ntimesteps x nstate x nens) ensemble run, as returned by run_lorenz_ensemble"""
+
+        statistics = cls(state_result_array.shape[0], state_result_array.shape[1], quantiles)
+        for i, state_timestep_array in enumerate(state_result_array):
+            statistics.update(i, state_estimate_array[i], state_timestep_array)
+
+        return statistics
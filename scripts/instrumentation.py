@@ -0,0 +1,121 @@
+"""
+
+Lorenz Data Assimilation
+
+Run instrumentation: per-phase timers and counters, and metrics recorded over time such as n_eff
+
+Scripted by dave.casson@usask.ca
+
+"""
+
+import contextlib
+import csv
+import json
+import time
+from collections import defaultdict
+
+
+class Profiler:
+    """Collects the wall time and number of calls of each phase of a run, event counters and metric time series
+
+    Phases of the assimilation loop: forecast, likelihood, weighting, resample, enkf_gain, estimate, result_append.
+    Counters: timesteps, analysis_steps, resample_events. Series: n_eff at each particle filter analysis step.
+
+    Each sink is called as sink(kind, name, value, timestep) for every phase, count and metric as it happens,
+    e.g. to stream a profile to a log or a monitoring system while the run continues.
+    """
+
+    def __init__(self, sinks=()):
+
+        self.phase_seconds = defaultdict(float)
+        self.phase_calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.series = defaultdict(list)
+        self.sinks = list(sinks)
+        self.timestep = None
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def emit(self, kind, name, value):
+        for sink in self.sinks:
+            sink(kind, name, value, self.timestep)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time the enclosed block as one call of the named phase"""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.phase_seconds[name] += elapsed
+            self.phase_calls[name] += 1
+            self.emit('phase', name, elapsed)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+        self.emit('count', name, n)
+
+    def record(self, name, value):
+        """Record the value of a metric at the current timestep"""
+
+        self.series[name].append((self.timestep, float(value)))
+        self.emit('metric', name, value)
+
+    def summary(self):
+        """Profile as a dictionary: phases with their total seconds, calls and share of the timed total,
+        the counters and the metric series"""
+
+        total_seconds = sum(self.phase_seconds.values())
+        phases = {name: {'seconds': seconds,
+                         'calls': self.phase_calls[name],
+                         'fraction': seconds / total_seconds if total_seconds > 0 else 0.}
+                  for name, seconds in sorted(self.phase_seconds.items(), key=lambda item: -item[1])}
+
+        return {'phases': phases,
+                'counters': dict(self.counters),
+                'series': {name: [list(point) for point in points] for name, points in self.series.items()}}
+
+    def to_json(self, path):
+        with open(path, 'w') as profile_file:
+            json.dump(self.summary(), profile_file, indent=2)
+
+    def to_csv(self, path):
+        """Write the profile in long form, one row of (kind, name, timestep, value) per entry"""
+
+        with open(path, 'w', newline='') as profile_file:
+            writer = csv.writer(profile_file)
+            writer.writerow(['kind', 'name', 'timestep', 'value'])
+            for name, seconds in self.phase_seconds.items():
+                writer.writerow(['phase_seconds', name, '', seconds])
+                writer.writerow(['phase_calls', name, '', self.phase_calls[name]])
+            for name, value in self.counters.items():
+                writer.writerow(['count', name, '', value])
+            for name, points in self.series.items():
+                for timestep, value in points:
+                    writer.writerow(['metric', name, timestep, value])
+
+
+class NullProfiler:
+    """Profiler with the same interface that records nothing, the default so that an uninstrumented run
+    pays almost nothing for the instrumentation points"""
+
+    timestep = None
+    _null_phase = contextlib.nullcontext()
+
+    def add_sink(self, sink):
+        raise ValueError('The NullProfiler records nothing, use a Profiler to attach sinks')
+
+    def phase(self, name):
+        return self._null_phase
+
+    def count(self, name, n=1):
+        pass
+
+    def record(self, name, value):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
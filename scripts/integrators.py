@@ -0,0 +1,131 @@
+"""
+
+Lorenz Data Assimilation
+
+Time integrators, used by both the deterministic and the ensemble runs
+
+Scripted by dave.casson@usask.ca
+
+"""
+
+import numpy as np
+
+# Each step function advances state by delta_t in place. derivative holds the tendency at the start of the step
+# and is updated to the tendency at the end of the step, so it is reused as the first stage of the next step.
+# tendency(state, *params, out=None) evaluates the model equations, e.g. ensemble_forecast.lorenz_derivative
+
+def euler_step(tendency, state, derivative, delta_t, params):
+    """Explicit euler, first order"""
+
+    state += derivative * delta_t
+    tendency(state, *params, out=derivative)
+
+    return state, derivative
+
+def heun_step(tendency, state, derivative, delta_t, params):
+    """Heun's method (explicit trapezoidal rule), second order"""
+
+    k2 = tendency(state + derivative * delta_t, *params)
+
+    state += (derivative + k2) * (delta_t / 2)
+    tendency(state, *params, out=derivative)
+
+    return state, derivative
+
+def rk4_step(tendency, state, derivative, delta_t, params):
+    """Classical fourth order Runge-Kutta"""
+
+    k2 = tendency(state + derivative * (delta_t / 2), *params)
+    k3 = tendency(state + k2 * (delta_t / 2), *params)
+    k4 = tendency(state + k3 * delta_t, *params)
+
+    state += (derivative + 2 * k2 + 2 * k3 + k4) * (delta_t / 6)
+    tendency(state, *params, out=derivative)
+
+    return state, derivative
+
+def bogacki_shampine_step(tendency, state, derivative, delta_t, params):
+    """Embedded Bogacki-Shampine 3(2) pair. Returns new arrays for the state, its derivative and the error estimate"""
+
+    k2 = tendency(state + derivative * (delta_t / 2), *params)
+    k3 = tendency(state + k2 * (3 * delta_t / 4), *params)
+
+    new_state = state + (2 / 9 * derivative + 1 / 3 * k2 + 4 / 9 * k3) * delta_t
+    new_derivative = tendency(new_state, *params)
+
+    error = (-5 / 72 * derivative + 1 / 12 * k2 + 1 / 9 * k3 - 1 / 8 * new_derivative) * delta_t
+
+    return new_state, new_derivative, error
+
+def adaptive_advance(tendency, state, derivative, interval, params, rtol, atol, step_size):
+    """Advance state in place over the interval with adaptive Bogacki-Shampine steps
+
+    The same step size is used for every ensemble member, controlled by the largest scaled error of any member.
+    Returns the state, derivative and the step size to start the next interval with
+    """
+
+    t = 0.
+    while interval - t > interval * 1e-12:
+
+        delta_t = min(step_size, interval - t)
+        new_state, new_derivative, error = bogacki_shampine_step(tendency, state, derivative, delta_t, params)
+
+        scale = atol + rtol * np.maximum(np.abs(state), np.abs(new_state))
+        error_norm = np.max(np.abs(error) / scale)
+
+        if not np.isfinite(error_norm) or step_size < interval * 1e-12:
+            raise RuntimeError('Adaptive integrator failed, the step size has collapsed')
+
+        factor = min(5., max(0.2, 0.9 * error_norm ** (-1 / 3))) if error_norm > 0 else 5.
+
+        if error_norm <= 1:
+            t += delta_t
+            state[...] = new_state
+            derivative[...] = new_derivative
+            #A step shortened to land on the end of the interval does not limit the next interval
+            if delta_t < step_size:
+                continue
+
+        step_size = delta_t * factor
+
+    return state, derivative, step_size
+
+STEPPERS = {'euler': euler_step,
+            'heun': heun_step,
+            'rk4': rk4_step}
+
+def create_stepper(tendency, delta_t, integrator='euler', n_substeps=1, rtol=1e-6, atol=1e-6):
+    """Create advance(state, derivative, params), moving the model forward one output interval delta_t in place
+
+    integrator is one of euler, heun, rk4 (taking n_substeps equal internal steps per interval)
+    or adaptive (embedded Bogacki-Shampine steps controlled by rtol and atol)
+    advance.controller holds the state carried between intervals (the adaptive step size), e.g. for checkpoints
+    """
+
+    if integrator == 'adaptive':
+        controller = {'step_size': delta_t / n_substeps}
+
+        def advance(state, derivative, params):
+            state, derivative, controller['step_size'] = adaptive_advance(tendency, state, derivative, delta_t,
+                                                                          params, rtol, atol,
+                                                                          controller['step_size'])
+            return state, derivative
+
+        advance.controller = controller
+        return advance
+
+    step = STEPPERS[integrator]
+    substep_delta_t = delta_t / n_substeps
+
+    def advance(state, derivative, params):
+        for substep in range(n_substeps):
+            step(tendency, state, derivative, substep_delta_t, params)
+        return state, derivative
+
+    advance.controller = {}
+    return advance
+
+def create_stepper_from_settings(settings, tendency):
+    """Create the stepper set by the integrator, n_substeps, rtol and atol settings"""
+    return create_stepper(tendency, settings['delta_t'], settings['integrator'], settings['n_substeps'],
+                          settings['rtol'], settings['atol'])
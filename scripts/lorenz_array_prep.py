@@ -9,28 +9,45 @@ Scripted by dave.casson@usask.ca
 """
 
 import numpy as np
+from collections import namedtuple
+
+from . import models
+
+# Sparse observations: sorted timestep indices (nmeas), observed values (nmeas x nobs) and error variance (nmeas)
+Observations = namedtuple('Observations', ['index', 'values', 'variance'])
 
 def create_parameter_arrays(settings,mode):
-    """ Create parameter arrays for the mode (base or modified) case """
-    rho_array  = np.ones(settings['num_timesteps'])*settings[f'rho_{mode}']
-    psi_array  = np.ones(settings['num_timesteps'])*settings[f'psi_{mode}']
-    beta_array = np.ones(settings['num_timesteps'])*settings[f'beta_{mode}']
+    """ Create parameter arrays for the mode (base or modified) case, one for each parameter of the model
+        e.g. rho, psi and beta for Lorenz-63 """
 
-    return rho_array, psi_array, beta_array
+    return tuple(np.ones(settings['num_timesteps'])*settings[f'{name}_{mode}']
+                 for name in models.get_model(settings).parameter_names)
 
-def create_ens_arrays(settings):
+def create_ens_arrays(settings, rng=np.random):
     """Create ensemble arrays, by generating random numbers scaled by the variance, and
-        applying to a multiplicative factor"""
+        applying to a multiplicative factor. rng can be a seeded np.random.Generator
+        Returns one (nens) array for each parameter of the model, e.g. rho, psi and beta for Lorenz-63"""
+
+    parameter_names = models.get_model(settings).parameter_names
+    param_vars = [rng.normal(loc=0, scale=settings[f'{name}_var'], size=settings['num_ens'])
+                  for name in parameter_names]
+
+    return tuple(settings[f'{name}_mod'] * (1 + param_var) for name, param_var in zip(parameter_names, param_vars))
 
-    rho_var  = np.random.normal(loc=0, scale=settings['rho_var'], size=settings['num_ens'])
-    psi_var  = np.random.normal(loc=0, scale=settings['psi_var'], size=settings['num_ens'])
-    beta_var = np.random.normal(loc=0, scale=settings['beta_var'], size=settings['num_ens'])
+def estimated_parameter_index(settings):
+    """Index into the model parameter_names of the parameters named by settings['estimate_parameters'] e.g. psi or
+        rho,psi, which are estimated with the states. None estimates no parameters"""
 
-    rho_ens_array  = settings['rho_mod'] * (1 + rho_var)
-    psi_ens_array  = settings['psi_mod']  * (1 + psi_var)
-    beta_ens_array = settings['beta_mod']  * (1 + beta_var)
+    if settings['estimate_parameters'] == 'None':
+        return []
 
-    return rho_ens_array, psi_ens_array, beta_ens_array
+    parameter_names = models.get_model(settings).parameter_names
+    names = [name.strip() for name in settings['estimate_parameters'].split(',')]
+    for name in names:
+        if name not in parameter_names:
+            raise ValueError(f'Unknown parameter {name} in estimate_parameters, use {", ".join(parameter_names)}')
+
+    return [parameter_names.index(name) for name in names]
 
 def create_time_array(settings):
     """Create time array based on number of timesteps and increment"""
@@ -38,16 +55,46 @@ def create_time_array(settings):
 
 
 def create_measurement_array(settings,base_run_array):
-    """Create an array of measurements. This samples the base, or perfect, model run at a set frequency"""
+    """Create an array of measurements. This samples the base, or perfect, model run at a set frequency
 
-    #Create array of nan values
-    meas_array = np.empty(len(base_run_array))
-    meas_array[:] = np.nan
+    A single variable (ntimesteps) gives a measurement array (ntimesteps). A full base run (nstate x ntimesteps)
+    is observed through the observation operator, giving a measurement array (ntimesteps x nobs)
+    """
 
-    #If the index is exactly divisible by the measurement frequency, copy the measurement value.
-    for i, value in enumerate(meas_array):
-        int_check = i / settings['meas_freq']
-        if int_check.is_integer():
-            meas_array[i] = base_run_array[i]
+    if np.ndim(base_run_array) == 2:
+        base_run_array = np.transpose(observation_operator(settings) @ base_run_array)
+
+    #Create array of nan values, then copy the measurement values at every meas_freq timestep
+    meas_array = np.empty(np.shape(base_run_array))
+    meas_array[:] = np.nan
+    meas_array[::settings['meas_freq']] = base_run_array[::settings['meas_freq']]
 
     return meas_array
+
+def create_observations(settings, base_run_array, variance=None):
+    """Create sparse observations, sampling the base run (nstate x ntimesteps) through the observation operator
+        at every meas_freq timestep.
+
+    variance is the error variance of each observation (nmeas), by default settings['measurement_var']
+    """
+
+    index = np.arange(0, np.shape(base_run_array)[1], settings['meas_freq'])
+    values = np.transpose(observation_operator(settings) @ base_run_array[:, index])
+
+    if variance is None:
+        variance = np.full(len(index), float(settings['measurement_var']))
+
+    return Observations(index, values, np.asarray(variance, dtype=float))
+
+def observation_operator(settings):
+    """Create the observation operator H (nobs x nstate) of the model, e.g. from the u_H, v_H and w_H settings
+        for Lorenz-63, see models"""
+
+    return models.get_model(settings).observation_operator(settings)
+
+def observation_error_variance(settings, nobs, variance=None):
+    """Create the diagonal of the observation error covariance R (nobs) for independent observation errors,
+        from the measurement variance, or from the error variance of a single observation if given"""
+    if variance is None:
+        variance = settings['measurement_var']
+    return np.full(nobs, float(variance))
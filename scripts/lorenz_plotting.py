@@ -10,23 +10,28 @@ Scripted by dave.casson@usask.ca
 
 import configparser
 import ast
+import os
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
-import pandas as pd
+import numpy as np
 import logging
 logging.basicConfig(level=logging.INFO)
 
+from .lorenz_array_prep import observation_operator
+
 
 def plot_3D_lorenz(settings,state_array):
     """Create 3D plot of Lorenz equations"""
     logging.info('Log test')
     fig = plt.figure(figsize=(20, 10))
-    ax = fig.gca(projection="3d")
+    ax = fig.add_subplot(projection="3d")
     ax.plot(state_array[0][:], state_array[1][:], state_array[1][:])
     ax.set_xlabel('u')
     ax.set_ylabel('y')
     ax.set_zlabel('w')
     ax.set_title(f"Lorenz System \n "
                  f"{settings['num_timesteps']} Timesteps")
+    os.makedirs('figures', exist_ok=True)
     plt.savefig('./figures/3DFigure.png')
 
     return
@@ -52,43 +57,98 @@ def plot_lorenz_basis(state_array_base_run):
     plt.ylabel('w')
     plt.xlabel('v')
     plt.plot(state_array_base_run[:][1], state_array_base_run[:][2])
+    os.makedirs('figures', exist_ok=True)
     plt.savefig('figures/BasisRun.png')
 
 
-def plot_ensembles(u_df,v_df,w_df):
+def plot_ensembles(state_array_ens_run):
+    """Create comparison plots of the u, v, and w variables for each member of a (ntimesteps x 3 x nens) ensemble run"""
 
-    for i in range(0, num_ens):
+    for i in range(0, state_array_ens_run.shape[2]):
         plt.figure(figsize=(20, 10))
 
         plt.subplot(131)
         plt.title('u vs v')
         plt.ylabel('v')
         plt.xlabel('u')
-        plt.plot(u_df[i],v_df[i])
+        plt.plot(state_array_ens_run[:, 0, i], state_array_ens_run[:, 1, i])
 
         plt.subplot(132)
         plt.title('u vs w')
         plt.ylabel('w')
         plt.xlabel('u')
-        plt.plot(u_df[i],w_df[i])
+        plt.plot(state_array_ens_run[:, 0, i], state_array_ens_run[:, 2, i])
 
         plt.subplot(133)
         plt.title('v vs w')
         plt.ylabel('w')
         plt.xlabel('v')
-        plt.plot(v_df[i], w_df[i])
+        plt.plot(state_array_ens_run[:, 1, i], state_array_ens_run[:, 2, i])
 
     plt.savefig(f'EnsembleRun.png')
 
-def plot_da_result(settings,state_array_base_run,state_array_mod_run,meas_array,
-                   state_array_ens_run, state_estimate_ens_run,t_array,da_mode):
+def bin_extremes(values, num_bins):
+    """Split a series into at most num_bins bins of consecutive points. Returns the index of the minimum and of the
+    maximum of each bin, in time order, NaN values are ignored unless a bin holds nothing else"""
+
+    n = len(values)
+    bin_size = -(-n // num_bins)
+    num_filled_bins = -(-n // bin_size)
+
+    padded = np.full(num_filled_bins * bin_size, np.nan)
+    padded[:n] = values
+    padded = padded.reshape(num_filled_bins, bin_size)
+
+    bin_start = np.arange(num_filled_bins) * bin_size
+    index_min = bin_start + np.argmin(np.where(np.isnan(padded), np.inf, padded), axis=1)
+    index_max = bin_start + np.argmax(np.where(np.isnan(padded), -np.inf, padded), axis=1)
+
+    return np.sort(np.stack([index_min, index_max], axis=1), axis=1).ravel()
+
+def decimate_minmax(t_array, values, num_bins):
+    """Reduce a series to the minimum and maximum of each of num_bins bins, which draws the same envelope
+    at a width of num_bins pixels. Series of up to two points per bin, or num_bins None, are left as they are"""
+
+    if num_bins is None or len(t_array) <= 2 * num_bins:
+        return t_array, values
+
+    index = bin_extremes(values, num_bins)
+    return t_array[index], values[index]
+
+def decimate_band(t_array, lower, upper, num_bins):
+    """Reduce a band to the lowest lower and the highest upper value of each of num_bins bins, drawn from the
+    first to the last time of the bin, so that the band is never narrower than at full resolution"""
+
+    if num_bins is None or len(t_array) <= 2 * num_bins:
+        return t_array, lower, upper
+
+    bin_size = -(-len(t_array) // num_bins)
+    bin_start = np.arange(0, len(t_array), bin_size)
+    bin_end = np.minimum(bin_start + bin_size, len(t_array)) - 1
 
-    u_final_ens = []
-    v_final_ens = []
-    w_final_ens = []
-    u_estimate  = []
-    v_estimate  = []
-    w_estimate  = []
+    band_t = np.stack([t_array[bin_start], t_array[bin_end]], axis=1).ravel()
+    band_lower = np.repeat(np.fmin.reduceat(lower, bin_start), 2)
+    band_upper = np.repeat(np.fmax.reduceat(upper, bin_start), 2)
+
+    return band_t, band_lower, band_upper
+
+def scatter_measurements(ax, settings, t_array, observations, variable, num_bins=None):
+    """Scatter the observations of one variable (0, 1 or 2 for u, v or w) onto ax, where it is observed directly.
+    With num_bins the measurements are min/max decimated, see decimate_minmax"""
+
+    for row, h_row in enumerate(observation_operator(settings)):
+        if h_row[variable] != 0 and np.count_nonzero(h_row) == 1:
+            ax.scatter(*decimate_minmax(t_array[observations.index], observations.values[:, row] / h_row[variable],
+                                        num_bins),
+                       marker='+', color='k', label='Measurements')
+
+def plot_da_result(settings,state_array_base_run,state_array_mod_run,observations,
+                   ensemble_statistics,t_array,da_mode,show=False,decimate=False):
+    """Plot the data assimilation result from the EnsembleStatistics of the run
+        (see run_lorenz_ensemble_statistics, or EnsembleStatistics.from_ensemble for a stored run)
+        The figure is saved as {da_mode}_result.png, and only shown in a window when show is True.
+        With decimate every series and band is reduced to the pixel width of the figure before drawing,
+        keeping the minimum and maximum of each pixel column, so long runs draw quickly"""
 
     length_t = settings['delta_t'] * settings['num_timesteps']
 
@@ -97,35 +157,29 @@ def plot_da_result(settings,state_array_base_run,state_array_mod_run,meas_array,
     else:
         plot_colour = 'green'
 
-    for i,val in enumerate(state_array_ens_run):
-        u_final_ens.append(state_array_ens_run[i][0])
-        v_final_ens.append(state_array_ens_run[i][1])
-        w_final_ens.append(state_array_ens_run[i][2])
+    # 5% and 95% quantiles of each variable, shape (2 x ntimesteps). The first three variables of the model are
+    # drawn, u, v and w of Lorenz-63
+    u_quantiles, v_quantiles, w_quantiles = ensemble_statistics.quantiles.transpose(2, 0, 1)[:3]
+    u_estimate, v_estimate, w_estimate = ensemble_statistics.estimate.T[:3]
 
-    for i,val in enumerate(state_estimate_ens_run):
-        u_estimate.append(state_estimate_ens_run[i][0])
-        v_estimate.append(state_estimate_ens_run[i][1])
-        w_estimate.append(state_estimate_ens_run[i][2])
+    '''Plotting Function'''
+    figure = plt.figure(figsize=(15,10))
 
-    u_df = pd.DataFrame(u_final_ens)
-    v_df = pd.DataFrame(v_final_ens)
-    w_df = pd.DataFrame(w_final_ens)
-    u_quantiles = u_df.quantile([.05, .95], axis=1)
-    v_quantiles = v_df.quantile([.05, .95], axis=1)
-    w_quantiles = w_df.quantile([.05, .95], axis=1)
+    # One bin per pixel column of the figure
+    num_bins = int(figure.get_figwidth() * figure.dpi) if decimate else None
+    series = lambda values: decimate_minmax(t_array, np.asarray(values), num_bins)
+    band = lambda quantiles: decimate_band(t_array, quantiles[0], quantiles[1], num_bins)
 
-    '''Plotting Function'''
-    plt.figure(figsize=(15,10))
     plt.suptitle(f'{da_mode} result')
     plt.subplot(311)
     plt.title('Basis Run')
     plt.title('u vs time')
     plt.ylabel('u')
     plt.xlabel('time')
-    plt.fill_between(t_array,u_quantiles.iloc[1].values, u_quantiles.iloc[0].values,alpha=0.3, color=plot_colour,label='5%-95%')
-    plt.scatter(t_array, meas_array, marker='+', color='k', label='Measurements')
-    plt.plot(t_array, state_array_mod_run[:][0], color='blue',label='Model')
-    plt.scatter(t_array, u_estimate, color=plot_colour, label='State Mean Estimate')
+    plt.fill_between(*band(u_quantiles),alpha=0.3, color=plot_colour,label='5%-95%')
+    scatter_measurements(plt.gca(), settings, t_array, observations, 0, num_bins)
+    plt.plot(*series(state_array_mod_run[:][0]), color='blue',label='Model')
+    plt.scatter(*series(u_estimate), color=plot_colour, label='State Mean Estimate')
     plt.legend()
 
     plt.subplot(312)
@@ -133,10 +187,11 @@ def plot_da_result(settings,state_array_base_run,state_array_mod_run,meas_array,
     plt.title('v vs time')
     plt.ylabel('v')
     plt.xlabel('time')
-    plt.fill_between(t_array,v_quantiles.iloc[1].values, v_quantiles.iloc[0].values,alpha=0.3, color=plot_colour,label='5%-95%')
-    plt.plot(t_array, state_array_base_run[:][1], color='black', label='Truth')
-    plt.plot(t_array, state_array_mod_run[:][1], color='blue', label='Model')
-    plt.scatter(t_array, v_estimate, color=plot_colour, label="State Mean Estimate")
+    plt.fill_between(*band(v_quantiles),alpha=0.3, color=plot_colour,label='5%-95%')
+    plt.plot(*series(state_array_base_run[:][1]), color='black', label='Truth')
+    plt.plot(*series(state_array_mod_run[:][1]), color='blue', label='Model')
+    scatter_measurements(plt.gca(), settings, t_array, observations, 1, num_bins)
+    plt.scatter(*series(v_estimate), color=plot_colour, label="State Mean Estimate")
     plt.legend()
 
     plt.subplot(313)
@@ -144,69 +199,80 @@ def plot_da_result(settings,state_array_base_run,state_array_mod_run,meas_array,
     plt.title('w vs time')
     plt.ylabel('w')
     plt.xlabel('time')
-    plt.fill_between(t_array,w_quantiles.iloc[1].values, w_quantiles.iloc[0].values,alpha=0.3, color=plot_colour,label='5%-95%')
-    plt.plot(t_array, state_array_base_run[:][2], color='black', label='Truth')
-    plt.plot(t_array, state_array_mod_run[:][2], color='blue', label='Model')
-    plt.scatter(t_array, w_estimate, color=plot_colour, label='State Mean Estimate')
+    plt.fill_between(*band(w_quantiles),alpha=0.3, color=plot_colour,label='5%-95%')
+    plt.plot(*series(state_array_base_run[:][2]), color='black', label='Truth')
+    plt.plot(*series(state_array_mod_run[:][2]), color='blue', label='Model')
+    scatter_measurements(plt.gca(), settings, t_array, observations, 2, num_bins)
+    plt.scatter(*series(w_estimate), color=plot_colour, label='State Mean Estimate')
     plt.legend()
     plt.legend()
     plt.xlim(0,length_t)
     plt.tight_layout()
     plt.savefig(f'{da_mode}_result.png')
-    plt.show()
+    if show:
+        plt.show()
+    else:
+        plt.close()
 
-def plot_da_result_test(settings,state_array_base_run,state_array_mod_run,meas_array,
-                   state_array_ens_run, state_estimate_ens_run,t_array,axs):
+def render_da_result(settings,state_array_base_run,state_array_mod_run,observations,
+                     ensemble_statistics,t_array,da_mode,decimate=True):
+    """Worker process entry point, drawing one decimated figure with the non-interactive Agg backend"""
 
+    plt.switch_backend('Agg')
+    plot_da_result(settings,state_array_base_run,state_array_mod_run,observations,
+                   ensemble_statistics,t_array,da_mode,show=False,decimate=decimate)
 
+    return f'{da_mode}_result.png'
 
-    u_final_ens = []
-    v_final_ens = []
-    w_final_ens = []
-    u_estimate  = []
-    v_estimate  = []
-    w_estimate  = []
+def plot_da_results_parallel(settings,state_array_base_run,state_array_mod_run,observations,
+                             statistics_by_mode,t_array,decimate=True,num_workers=None):
+    """Render the figure of each filter (statistics_by_mode maps da_mode to its EnsembleStatistics)
+        in its own worker process, writing the files without showing them. Returns the figure paths"""
 
-    length_t = settings['delta_t'] * settings['num_timesteps']
+    if not statistics_by_mode:
+        return []
+
+    with ProcessPoolExecutor(max_workers=num_workers or len(statistics_by_mode)) as pool:
+        futures = [pool.submit(render_da_result, settings, state_array_base_run, state_array_mod_run, observations,
+                               statistics, t_array, da_mode, decimate)
+                   for da_mode, statistics in statistics_by_mode.items()]
 
-    for i,val in enumerate(state_array_ens_run):
-        u_final_ens.append(state_array_ens_run[i][0])
-        v_final_ens.append(state_array_ens_run[i][1])
-        w_final_ens.append(state_array_ens_run[i][2])
+        return [future.result() for future in futures]
 
-    for i,val in enumerate(state_estimate_ens_run):
-        u_estimate.append(state_estimate_ens_run[i][0])
-        v_estimate.append(state_estimate_ens_run[i][1])
-        w_estimate.append(state_estimate_ens_run[i][2])
+def plot_da_result_test(settings,state_array_base_run,state_array_mod_run,observations,
+                   ensemble_statistics,t_array,axs):
+    """Plot the data assimilation result onto the three provided axes, see plot_da_result"""
+
+    length_t = settings['delta_t'] * settings['num_timesteps']
 
-    u_df = pd.DataFrame(u_final_ens)
-    v_df = pd.DataFrame(v_final_ens)
-    w_df = pd.DataFrame(w_final_ens)
-    u_quantiles = u_df.quantile([.05, .95], axis=1)
-    v_quantiles = v_df.quantile([.05, .95], axis=1)
-    w_quantiles = w_df.quantile([.05, .95], axis=1)
+    # 5% and 95% quantiles of each variable, shape (2 x ntimesteps). The first three variables of the model are
+    # drawn, u, v and w of Lorenz-63
+    u_quantiles, v_quantiles, w_quantiles = ensemble_statistics.quantiles.transpose(2, 0, 1)[:3]
+    u_estimate, v_estimate, w_estimate = ensemble_statistics.estimate.T[:3]
 
     axs[0].set_title('u vs time')
     axs[0].set(xlabel='time', ylabel='v')
-    axs[0].fill_between(t_array,u_quantiles.iloc[1].values, u_quantiles.iloc[0].values,alpha=0.3, color='r',label='5%-95%')
-    axs[0].scatter(t_array, meas_array, marker='+', color='k', label='Measurements')
+    axs[0].fill_between(t_array,u_quantiles[1], u_quantiles[0],alpha=0.3, color='r',label='5%-95%')
+    scatter_measurements(axs[0], settings, t_array, observations, 0)
     axs[0].plot(t_array, state_array_mod_run[:][0], color='blue',label='Model')
     axs[0].scatter(t_array, u_estimate, color='red', label='State Mean Estimate')
     axs[0].legend()
 
     axs[1].set_title('v vs time')
     axs[1].set(xlabel = 'time',ylabel='v')
-    axs[1].fill_between(t_array,v_quantiles.iloc[1].values, v_quantiles.iloc[0].values,alpha=0.3, color='r',label='5%-95%')
+    axs[1].fill_between(t_array,v_quantiles[1], v_quantiles[0],alpha=0.3, color='r',label='5%-95%')
     axs[1].plot(t_array, state_array_base_run[:][1], color='black', label='Truth')
     axs[1].plot(t_array, state_array_mod_run[:][1], color='blue', label='Model')
+    scatter_measurements(axs[1], settings, t_array, observations, 1)
     axs[1].scatter(t_array, v_estimate, color='red', label="State Mean Estimate")
     axs[1].legend()
 
     axs[2].set_title('w vs time')
     axs[2].set(xlabel = 'time',ylabel='w')
-    axs[2].fill_between(t_array,w_quantiles.iloc[1].values, w_quantiles.iloc[0].values,alpha=0.3, color='r',label='5%-95%')
+    axs[2].fill_between(t_array,w_quantiles[1], w_quantiles[0],alpha=0.3, color='r',label='5%-95%')
     axs[2].plot(t_array, state_array_base_run[:][2], color='black', label='Truth')
     axs[2].plot(t_array, state_array_mod_run[:][2], color='blue', label='Model')
+    scatter_measurements(axs[2], settings, t_array, observations, 2)
     axs[2].scatter(t_array, w_estimate, color='red', label='State Mean Estimate')
     axs[2].legend()
     axs[2].legend()
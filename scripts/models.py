@@ -0,0 +1,103 @@
+"""
+
+Lorenz Data Assimilation
+
+Model definitions: a state vector of any dimension advanced by a tendency function
+
+A Model holds the tendency(state, *params, out=None) evaluated by the integrators, the names of its parameters
+(in the order they are passed to the tendency), and functions of the settings giving the state dimension, the
+initial state of the base or modified run, the observation operator, and the distance between state variables
+used for covariance localization. The model is chosen by settings['model'].
+Each parameter name has {name}_base, {name}_mod and {name}_var settings, see lorenz_array_prep.
+
+Scripted by dave.casson@usask.ca
+
+"""
+
+import numpy as np
+from collections import namedtuple
+
+from .ensemble_forecast import lorenz_derivative, lorenz96_derivative
+
+Model = namedtuple('Model', ['name', 'parameter_names', 'tendency', 'n_state', 'initial_state',
+                             'observation_operator', 'distance'])
+
+
+def lorenz63_dimension(settings):
+    return 3
+
+
+def lorenz63_initial_state(settings, mode):
+    """Initial state (3) of the mode (base or mod) run, from the u_ini, v_ini and w_ini settings"""
+    return np.array([settings[f'u_ini_{mode}'], settings[f'v_ini_{mode}'], settings[f'w_ini_{mode}']], dtype=float)
+
+
+def lorenz63_observation_operator(settings):
+    """Observation operator H (nobs x 3) from the u_H, v_H and w_H settings
+
+    Each variable with a non-zero setting is observed, giving one row of H scaled by that setting
+    """
+
+    h_weights = np.array([settings['u_h'], settings['v_h'], settings['w_h']], dtype=float)
+    observed_variables = np.flatnonzero(h_weights)
+
+    H = np.zeros((len(observed_variables), 3))
+    H[np.arange(len(observed_variables)), observed_variables] = h_weights[observed_variables]
+
+    return H
+
+
+def lorenz63_distance(settings, i, j):
+    """Distance between variables i and j (broadcast index arrays). Lorenz-63 has no spatial structure, so every
+    variable is at distance zero and localization leaves its analysis unchanged"""
+    return np.zeros(np.broadcast(i, j).shape)
+
+
+def lorenz96_dimension(settings):
+    return settings['l96_dimension']
+
+
+def lorenz96_initial_state(settings, mode):
+    """Initial state (l96_dimension) of both runs: the rest state x = forcing_base, with the first variable
+    displaced by l96_perturbation to start the chaotic motion"""
+
+    state = np.full(settings['l96_dimension'], float(settings['forcing_base']))
+    state[0] += settings['l96_perturbation']
+
+    return state
+
+
+def lorenz96_observation_operator(settings):
+    """Observation operator H (nobs x l96_dimension) observing every l96_obs_every-th variable directly"""
+
+    observed_variables = np.arange(0, settings['l96_dimension'], settings['l96_obs_every'])
+
+    H = np.zeros((len(observed_variables), settings['l96_dimension']))
+    H[np.arange(len(observed_variables)), observed_variables] = 1.
+
+    return H
+
+
+def lorenz96_distance(settings, i, j):
+    """Distance in grid points between variables i and j (broadcast index arrays) around the ring"""
+
+    distance = np.abs(np.subtract(i, j)) % settings['l96_dimension']
+    return np.minimum(distance, settings['l96_dimension'] - distance)
+
+
+MODELS = {
+    'lorenz63': Model('lorenz63', ('rho', 'psi', 'beta'), lorenz_derivative,
+                      lorenz63_dimension, lorenz63_initial_state, lorenz63_observation_operator, lorenz63_distance),
+    'lorenz96': Model('lorenz96', ('forcing',), lorenz96_derivative,
+                      lorenz96_dimension, lorenz96_initial_state, lorenz96_observation_operator, lorenz96_distance),
+}
+
+
+def get_model(settings):
+    """Model selected by settings['model'], Lorenz-63 if the setting is absent e.g. in older settings files"""
+
+    name = settings.get('model', 'lorenz63')
+    if name not in MODELS:
+        raise ValueError(f'Unknown model {name}, use {", ".join(MODELS)}')
+
+    return MODELS[name]
@@ -0,0 +1,226 @@
+"""
+
+Lorenz Data Assimilation
+
+Online data assimilation, with observations arriving asynchronously while the ensemble runs
+
+Observation messages are dictionaries {'timestep': i, 'values': [...], 'variance': optional, 'sent': optional
+time.time() of sending}, sent as json lines by the file and socket sources. A null message ends the stream.
+
+Scripted by dave.casson@usask.ca
+
+"""
+
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from .ensemble_statistics import EnsembleStatistics
+
+
+class BlockingArray:
+    """Read-only view of an array whose rows are filled in later. Reading row k first waits for it"""
+
+    def __init__(self, array, wait):
+        self.array = array
+        self.wait = wait
+
+    def __getitem__(self, k):
+        self.wait(k)
+        return self.array[k]
+
+
+class PendingObservations:
+    """Observations on a schedule of timesteps, delivered while the filter runs
+
+    Used in place of the Observations of an offline run. The assimilation loop reads values[k] once it has
+    forecast to the k-th observation timestep, which blocks until that observation is delivered. An observation
+    that has not arrived max_wait seconds later, or by the time the source closes, reads as NaN and its analysis
+    is skipped.
+    """
+
+    def __init__(self, index, nobs, variance, max_wait=None):
+
+        self.index = np.asarray(index)
+        self.max_wait = max_wait
+        # A slot is set once its observation has arrived or has been given up on, after which it never changes.
+        # The lock makes checking and setting a slot one step, so a late delivery cannot race the timeout
+        self.arrived = [threading.Event() for _ in self.index]
+        self.lock = threading.Lock()
+        self.received = np.full(len(self.index), np.nan)
+        self.sent = np.full(len(self.index), np.nan)
+
+        self.observation_values = np.full((len(self.index), nobs), np.nan)
+        self.observation_variance = np.full(len(self.index), float(variance))
+        self.values = BlockingArray(self.observation_values, self.wait)
+        self.variance = BlockingArray(self.observation_variance, self.wait)
+
+    def wait(self, k):
+        if self.arrived[k].wait(self.max_wait):
+            return
+
+        with self.lock:
+            if not self.arrived[k].is_set():
+                logging.warning(f'Observation of timestep {self.index[k]} did not arrive, skipping its analysis')
+                self.arrived[k].set()
+
+    def deliver(self, message):
+        """Add an observation message, stamping its arrival time. Messages off the schedule, or arriving after
+        the filter has passed their timestep, are dropped"""
+
+        k = np.searchsorted(self.index, message['timestep'])
+        if k == len(self.index) or self.index[k] != message['timestep']:
+            logging.warning(f'Dropping the observation of timestep {message["timestep"]}, it is not expected')
+            return
+
+        with self.lock:
+            if self.arrived[k].is_set():
+                logging.warning(f'Dropping the observation of timestep {message["timestep"]}, it arrived too late')
+                return
+
+            self.observation_values[k] = message['values']
+            if message.get('variance') is not None:
+                self.observation_variance[k] = message['variance']
+            self.sent[k] = message.get('sent', np.nan)
+            self.received[k] = time.time()
+            self.arrived[k].set()
+
+    def close(self):
+        """No more observations will arrive, the remaining timesteps are forecast only"""
+        with self.lock:
+            for arrived in self.arrived:
+                arrived.set()
+
+
+def parse_message(line):
+    """Parse a json line into an observation message, or None at the end of the stream"""
+    return json.loads(line)
+
+
+async def queue_source(queue):
+    """Observations put on an asyncio.Queue, an in-process stand-in for a live feed. None ends the stream"""
+
+    while True:
+        message = await queue.get()
+        if message is None:
+            return
+        yield message
+
+
+async def file_source(path, poll_interval=0.05):
+    """Observations appended as json lines to a file, which is tailed until a null line"""
+
+    while not os.path.exists(path):
+        await asyncio.sleep(poll_interval)
+
+    with open(path) as observation_file:
+        line = ''
+        while True:
+            line += observation_file.readline()
+            if not line.endswith('\n'):
+                # Wait for the rest of a line that is still being written
+                await asyncio.sleep(poll_interval)
+                continue
+
+            message = parse_message(line)
+            line = ''
+            if message is None:
+                return
+            yield message
+
+
+async def socket_source(host='127.0.0.1', port=0, bound=None):
+    """Observations sent as json lines over TCP connections to a local server, until a null line
+
+    bound is an optional asyncio.Future, set to the (host, port) the server listens on once it has started
+    """
+
+    messages = asyncio.Queue()
+
+    async def receive(reader, writer):
+        async for line in reader:
+            await messages.put(parse_message(line))
+        writer.close()
+
+    server = await asyncio.start_server(receive, host, port)
+    if bound is not None:
+        bound.set_result(server.sockets[0].getsockname()[:2])
+
+    async with server:
+        async for message in queue_source(messages):
+            yield message
+
+
+def latency_summary(latency):
+    """Mean, median, 95th percentile and maximum of latencies in seconds"""
+
+    latency = np.asarray(latency)
+    if len(latency) == 0:
+        return {}
+    return {'count': len(latency), 'mean': float(np.mean(latency)), 'median': float(np.median(latency)),
+            'p95': float(np.percentile(latency, 95)), 'max': float(np.max(latency))}
+
+
+async def assimilate_online(settings, params, t_array, da_mode, source, rng=None, observation_steps=None,
+                            max_wait=None, consumers=(), profiler=None):
+    """Run the filter while observations arrive from an asynchronous source (queue_source, file_source,
+    socket_source or any async iterator of observation messages). params are the ensemble parameter arrays of the
+    model, see lorenz_array_prep.create_ens_arrays
+
+    The ensemble forecasts to the next observation timestep (by default every meas_freq timestep) while it waits,
+    and the analysis is applied as soon as the observation lands. The filter runs in a worker thread, so the
+    source keeps being read during the forecast.
+
+    Returns the EnsembleStatistics of the run and the latencies (nmeas x 2): from the arrival of each assimilated
+    observation to its analysis, and end to end from when it was sent (NaN if the message has no 'sent' time)
+    """
+
+    #Imported here, as the top level script imports the scripts package
+    import lorenz_data_assimilation
+    from .lorenz_array_prep import observation_operator
+    from .models import get_model
+
+    if observation_steps is None:
+        observation_steps = np.arange(0, len(t_array), settings['meas_freq'])
+    observations = PendingObservations(observation_steps, len(observation_operator(settings)),
+                                       settings['measurement_var'], max_wait)
+    statistics = EnsembleStatistics(len(t_array), get_model(settings).n_state(settings))
+
+    async def receive():
+        try:
+            async for message in source:
+                observations.deliver(message)
+        finally:
+            observations.close()
+
+    def run_filter():
+        latency = []
+        k = 0
+        for item in lorenz_data_assimilation.stream_ensemble(settings, params, t_array, da_mode, observations, rng,
+                                                             profiler):
+            analysed = time.time()
+            if k < len(observation_steps) and item[0] == observation_steps[k]:
+                if not np.isnan(observations.observation_values[k]).any():
+                    latency.append((analysed - observations.received[k], analysed - observations.sent[k]))
+                k += 1
+
+            for consumer in (statistics, *consumers):
+                consumer(*item)
+
+        return np.array(latency).reshape(-1, 2)
+
+    receiver = asyncio.create_task(receive())
+    try:
+        latency = await asyncio.to_thread(run_filter)
+    finally:
+        receiver.cancel()
+        observations.close()
+
+    logging.info(f'Observation to analysis latency (s): {latency_summary(latency[:, 0])}')
+
+    return statistics, latency
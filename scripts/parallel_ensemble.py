@@ -0,0 +1,175 @@
+"""
+
+Lorenz Data Assimilation
+
+Process sharded ensemble execution, with the ensemble state held in shared memory
+
+Scripted by dave.casson@usask.ca
+
+"""
+
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+
+from .models import get_model
+from .integrators import create_stepper_from_settings
+
+
+def attach_shared_array(name, shape, dtype=np.float64):
+    """Attach to an existing shared memory buffer, returning the buffer and an ndarray view of it"""
+
+    #Workers share the driver's resource tracker, the driver unlinks the buffer once the run is finished
+    buffer = shared_memory.SharedMemory(name=name)
+
+    return buffer, np.ndarray(shape, dtype=dtype, buffer=buffer.buf)
+
+
+def shard_worker(connection, buffer_names, layout, first, last, settings, seed):
+    """Worker process loop, advancing members first:last of the shared ensemble on each 'forecast' command
+
+    'perturb' fills the shard of the shared (nobs x nens) buffer with standard normal draws from the shard's
+    own np.random.Generator, used for the EnKF measurement perturbations. 'get_state' replies with the generator
+    and integrator state of the shard, ('set_state', shard_state) restores it. None stops the worker.
+    """
+
+    buffers = {}
+    arrays = {}
+    for key, (shape, dtype) in layout.items():
+        buffers[key], arrays[key] = attach_shared_array(buffer_names[key], shape, dtype)
+
+    state = arrays['state'][:, first:last]
+    derivative = arrays['derivative'][:, first:last]
+    noise = arrays['noise'][:, first:last]
+    params = tuple(arrays['params'][:, first:last])
+
+    advance = create_stepper_from_settings(settings, get_model(settings).tendency)
+    rng = np.random.default_rng(seed)
+
+    while True:
+        command = connection.recv()
+
+        if command is None:
+            break
+        if command == 'forecast':
+            advance(state, derivative, params)
+        if command == 'perturb':
+            noise[:] = rng.standard_normal(noise.shape)
+        if command == 'get_state':
+            connection.send({'rng': rng.bit_generator.state, 'controller': advance.controller})
+            continue
+        if isinstance(command, tuple) and command[0] == 'set_state':
+            rng.bit_generator.state = command[1]['rng']
+            advance.controller.update(command[1]['controller'])
+
+        connection.send(True)
+
+    del state, derivative, noise, params, arrays
+    for buffer in buffers.values():
+        buffer.close()
+    connection.close()
+
+
+class ShardedEnsemble:
+    """Ensemble state, derivative and parameters in shared memory, split into shards of members that are
+    forecast in parallel by worker processes.
+
+    state, derivative and params are (nstate x nens), (nstate x nens) and (nparams x nens) views of the shared buffers,
+    so the driver does the global reductions (weights, resampling, EnKF mean and covariance) on them in place
+    without the ensemble ever being pickled. Each shard draws random numbers from its own seeded stream.
+    """
+
+    def __init__(self, settings, state_array, derivative_array, params, nobs, num_workers, seed_sequences):
+
+        n_state, num_ens = np.shape(state_array)
+
+        # Shape and type of each shared buffer, the ensemble arrays keep the type of state_array
+        dtype = np.asarray(state_array).dtype
+        layout = {'state': ((n_state, num_ens), dtype), 'derivative': ((n_state, num_ens), dtype),
+                  'params': ((len(params), num_ens), dtype), 'noise': ((nobs, num_ens), np.dtype(np.float64))}
+
+        self.buffers = {}
+        arrays = {}
+        for key, (shape, buffer_dtype) in layout.items():
+            size = max(1, buffer_dtype.itemsize * int(np.prod(shape)))
+            self.buffers[key] = shared_memory.SharedMemory(create=True, size=size)
+            arrays[key] = np.ndarray(shape, dtype=buffer_dtype, buffer=self.buffers[key].buf)
+
+        self.state = arrays['state']
+        self.derivative = arrays['derivative']
+        self.params = arrays['params']
+        self.noise = arrays['noise']
+        self.state[:] = state_array
+        self.derivative[:] = derivative_array
+        self.params[:] = params
+
+        buffer_names = {key: buffer.name for key, buffer in self.buffers.items()}
+        shard_edges = np.linspace(0, num_ens, num_workers + 1).astype(int)
+
+        self.connections = []
+        self.workers = []
+        for shard in range(num_workers):
+            connection, worker_connection = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=shard_worker,
+                                             args=(worker_connection, buffer_names, layout, shard_edges[shard],
+                                                   shard_edges[shard + 1], settings, seed_sequences[shard]),
+                                             daemon=True)
+            worker.start()
+            self.connections.append(connection)
+            self.workers.append(worker)
+
+    def command(self, command):
+        """Send a command to every worker and wait until all shards have finished it"""
+        for connection in self.connections:
+            connection.send(command)
+        for connection in self.connections:
+            connection.recv()
+
+    def forecast(self):
+        """Advance every shard one timestep in parallel"""
+        self.command('forecast')
+
+    def standard_normal(self):
+        """Draw standard normal values (nobs x nens), each shard from its own stream"""
+        self.command('perturb')
+        return self.noise
+
+    def get_state(self):
+        """Generator and integrator state of every shard, see set_state"""
+
+        for connection in self.connections:
+            connection.send('get_state')
+        return [connection.recv() for connection in self.connections]
+
+    def set_state(self, shard_states):
+        """Restore the generator and integrator state of every shard, e.g. from a checkpoint"""
+
+        for connection, shard_state in zip(self.connections, shard_states):
+            connection.send(('set_state', shard_state))
+        for connection in self.connections:
+            connection.recv()
+
+    def close(self):
+        """Stop the workers and release the shared memory"""
+
+        for connection in self.connections:
+            connection.send(None)
+        for worker in self.workers:
+            worker.join()
+        for connection in self.connections:
+            connection.close()
+
+        del self.state, self.derivative, self.params, self.noise
+        for buffer in self.buffers.values():
+            buffer.unlink()
+            try:
+                buffer.close()
+            except BufferError:
+                #A consumer still holds a view of the ensemble, the memory is released when it is dropped
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,4 +1,3 @@
-
 """
 
 Particle Filter Class
@@ -11,27 +10,39 @@ Scripting by Dave Casson, dave.casson@usask.ca
 
 
 
-import matplotlib.pyplot as plt
 import numpy as np
 
-def calculate_likelihoods(settings,state_array,measurement):
-    """Calculate likelihood of each particle based on error """
+from .lorenz_array_prep import observation_operator
 
-    errors = []
-    likelihoods = []
+def calculate_log_likelihoods(settings,state_array,measurement,H=None,variance=None):
+    """Calculate the log likelihood of every particle based on its error, as one operation over the ensemble
 
-    for ens in range(0, settings['num_ens']):
+    H is the observation operator (nobs x nstate), by default from the u_H, v_H and w_H settings
+    variance is the measurement error variance, by default settings['measurement_var']
+    The errors are computed in the precision of state_array, and their squares summed in float64
+    """
 
-        #Extract particle from state array
-        particle = state_array[0][ens]
+    if variance is None:
+        variance = settings['measurement_var']
 
-        #Calculate errors
-        error = abs(particle - measurement)
+    if H is None:
+        H = observation_operator(settings)
 
-        # Calculate Likelihood
-        likelihoods.append(np.exp(-0.5 * error * settings['measurement_var'] * error))
+    #Calculate errors of the measured variables for all particles (nobs x nens)
+    dtype = state_array.dtype
+    measurement = np.atleast_1d(measurement).astype(dtype, copy=False)
+    errors = measurement[:, np.newaxis] - H.astype(dtype, copy=False) @ state_array
 
-    return likelihoods
+    return -0.5 * np.sum(errors * errors, axis=0, dtype=np.float64) / variance
+
+def calculate_likelihoods(settings,state_array,measurement,H=None):
+    """Calculate likelihood of each particle based on error """
+    return np.exp(calculate_log_likelihoods(settings, state_array, measurement, H))
+
+def normalize_log_weights(log_weights):
+    """Normalize log weights so that the weights sum to one, using log-sum-exp to avoid underflow"""
+    log_max = np.max(log_weights)
+    return log_weights - (log_max + np.log(np.sum(np.exp(log_weights - log_max))))
 
 def calculate_weights(likelihoods):
     """Calculate weights based on likelihood"""
@@ -39,55 +50,72 @@ def calculate_weights(likelihoods):
     return weights
 
 def calculate_state_estimate(state_array,weights):
-
-    """Calculate state estimate based on the weight of each particle"""
-    u_est = np.average(state_array[0], weights=weights, axis=0)
-    v_est = np.average(state_array[1], weights=weights, axis=0)
-    w_est = np.average(state_array[2], weights=weights, axis=0)
-
-    state_estimate = [u_est,v_est,w_est]
-
-    return state_estimate
+    """Calculate state estimate (nstate) based on the weight of each particle"""
+    return np.average(state_array, weights=weights, axis=1)
 
 def calculate_neff(weights):
     """Calculate the effective weight of all particles"""
     return 1. / np.sum(np.square(weights))
 
-def resample(settings,state_array,weights):
-    """Resampling component of Sequential Importance Resampling algorithm """
-
-    #Create empty array the size of the number of ensembles
-    resample = np.empty((settings['num_ens']), dtype=int)
+def search_cumulative_weights(weights, positions):
+    """Find the particle index for each position in [0, 1), from the cumulative weights i.e. [0.02,0.06, .. ,1]"""
 
-    #Calculate an array of the cumulative weights i.e. [0.02,0.06, .. ,1]
     zweightcumul = np.cumsum(weights)
+    #Guard against the final cumulative weight rounding to just below one
+    zweightcumul[-1] = 1.
+
+    return np.searchsorted(zweightcumul, positions, side='left')
+
+def systematic_resample(weights, rng, num_samples=None):
+    """Systematic resampling, a single random offset shared by evenly spaced positions"""
+    num_samples = len(weights) if num_samples is None else num_samples
+    positions = (rng.random() + np.arange(num_samples)) / num_samples
+    return search_cumulative_weights(weights, positions)
+
+def stratified_resample(weights, rng, num_samples=None):
+    """Stratified resampling, one random position within each of the evenly spaced strata"""
+    num_samples = len(weights) if num_samples is None else num_samples
+    positions = (rng.random(num_samples) + np.arange(num_samples)) / num_samples
+    return search_cumulative_weights(weights, positions)
+
+def multinomial_resample(weights, rng, num_samples=None):
+    """Multinomial resampling, independent random positions (sorted, so the index is in particle order)"""
+    num_samples = len(weights) if num_samples is None else num_samples
+    positions = np.sort(rng.random(num_samples))
+    return search_cumulative_weights(weights, positions)
+
+def residual_resample(weights, rng, num_samples=None):
+    """Residual resampling, deterministic copies of floor(N * weight) with the remainder drawn multinomially"""
+    num_samples = len(weights) if num_samples is None else num_samples
 
-    #Generate a random seed / value, and divide by the number of ensembles
-    zrand = np.random.random() / settings['num_ens']
+    num_copies = np.floor(num_samples * np.asarray(weights)).astype(int)
+    resample_index = np.repeat(np.arange(len(weights)), num_copies)
 
-    #Loop through particles
-    for ires in range(0, settings['num_ens']):
-        #If the value is lower than the first weight, assign it to the first index.
-        if zrand <= zweightcumul[0]:
-            resample[ires] = 1
+    num_residual = num_samples - len(resample_index)
+    if num_residual > 0:
+        residual_weights = num_samples * np.asarray(weights) - num_copies
+        residual_weights /= np.sum(residual_weights)
+        resample_index = np.concatenate([resample_index,
+                                         multinomial_resample(residual_weights, rng, num_residual)])
 
-        #Check where the seed falls within the array of weights, then assign an index.
-        for rk in range(1, settings['num_ens']):
-            if (zweightcumul[rk - 1] < zrand) and (zrand <= zweightcumul[rk]):
-                resample[ires] = rk + 1
+    return resample_index
 
-        #Increment the random seed forward, by 1 / num_ens
-        zrand += 1. / settings['num_ens']
+RESAMPLE_SCHEMES = {'systematic': systematic_resample,
+                    'stratified': stratified_resample,
+                    'multinomial': multinomial_resample,
+                    'residual': residual_resample}
 
-    #Index correction needed due to python indexing
-    resample_index = resample - 1
+def resample_index(settings, weights, rng, num_samples=None):
+    """Calculate the re-sampling index, with the scheme set by settings['resample_scheme']"""
+    return RESAMPLE_SCHEMES[settings['resample_scheme']](weights, rng, num_samples)
 
-    # Resample according to re-sampling index
-    for i, value in enumerate(resample_index):
-        state_array[0][i] = state_array[0][value]
-        state_array[1][i] = state_array[1][value]
-        state_array[2][i] = state_array[2][value]
+def resample(settings,state_array,weights,rng=None):
+    """Resampling component of Sequential Importance Resampling algorithm
 
-    return state_array
+    Returns a new (nstate x nens) array, so no particle is overwritten before it has been copied
+    """
 
+    if rng is None:
+        rng = np.random.default_rng()
 
+    return state_array[:, resample_index(settings, weights, rng)]
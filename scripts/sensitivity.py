@@ -0,0 +1,149 @@
+"""
+
+Lorenz Data Assimilation
+
+Batched deterministic runs, and the tangent linear model for finite-time Lyapunov exponents and error growth
+
+Scripted by dave.casson@usask.ca
+
+"""
+
+import numpy as np
+
+from .ensemble_forecast import lorenz_derivative
+from .integrators import create_stepper
+
+
+def batch_parameters(num_batch, rho, psi, beta):
+    """Per-run parameter arrays (nbatch), from scalars or arrays"""
+    return tuple(np.broadcast_to(np.asarray(param, dtype=float), (num_batch,)) for param in (rho, psi, beta))
+
+
+def run_lorenz_batch(initial_states, rho, psi, beta, t_array, delta_t, integrator='euler', n_substeps=1,
+                     rtol=1e-6, atol=1e-6):
+    """Run many deterministic trajectories in one vectorized pass, e.g. a grid of initial conditions and parameters
+
+    initial_states is (3 x nbatch), rho, psi and beta are scalars or per-run arrays (nbatch) held constant in time.
+    Each run matches run_lorenz_deterministic with the same settings. Returns the states (ntimesteps x 3 x nbatch)
+    """
+
+    initial_states = np.asarray(initial_states, dtype=float)
+    params = batch_parameters(initial_states.shape[1], rho, psi, beta)
+
+    state = initial_states.copy()
+    derivative = lorenz_derivative(state, *params)
+    advance = create_stepper(lorenz_derivative, delta_t, integrator, n_substeps, rtol, atol)
+
+    state_array = np.empty((len(t_array),) + state.shape)
+    state_array[0] = state
+    for i in range(1, len(t_array)):
+        advance(state, derivative, params)
+        state_array[i] = state
+
+    return state_array
+
+
+def tangent_linear_derivative(augmented_state, rho, psi, beta, out=None):
+    """Lorenz equations together with their tangent linear model
+
+    augmented_state is (12 x nbatch): the state (3) followed by three tangent vectors q (3 x 3, vector by component),
+    each evolving as dq/dt = J q with the Jacobian J = [[-rho, rho, 0], [psi - w, -1, -u], [v, u, -beta]]
+    """
+
+    if out is None:
+        out = np.empty(np.shape(augmented_state))
+
+    lorenz_derivative(augmented_state[0:3], rho, psi, beta, out=out[0:3])
+
+    u, v, w = augmented_state[0], augmented_state[1], augmented_state[2]
+    q = augmented_state[3:].reshape(3, 3, -1)
+    dq_dt = out[3:].reshape(3, 3, -1)
+    q_u, q_v, q_w = q[:, 0], q[:, 1], q[:, 2]
+
+    dq_dt[:, 0] = rho * (q_v - q_u)
+    dq_dt[:, 1] = (psi - w) * q_u - q_v - u * q_w
+    dq_dt[:, 2] = v * q_u + u * q_v - beta * q_w
+
+    return out
+
+
+def finite_time_lyapunov_exponents(initial_states, rho, psi, beta, delta_t, num_timesteps, integrator='euler',
+                                   n_substeps=1, rtol=1e-6, atol=1e-6, renormalize_every=1, return_growth=False):
+    """Finite-time Lyapunov exponents of many runs over num_timesteps of delta_t, in one vectorized pass
+
+    Three tangent vectors are integrated with each state and re-orthonormalized by a QR decomposition every
+    renormalize_every timesteps, accumulating the log growth on the diagonal of R.
+    Returns the exponents (3 x nbatch), from the leading exponent down. With return_growth, also returns the
+    tangent linear error growth curves (ntimesteps + 1 x nbatch), the norm growth of the first tangent vector,
+    which starts along u. This is the linearized counterpart of error_growth, from the same integration
+    """
+
+    initial_states = np.asarray(initial_states, dtype=float)
+    num_batch = initial_states.shape[1]
+    params = batch_parameters(num_batch, rho, psi, beta)
+
+    #The tangent vectors start as the unit vectors
+    state = np.empty((12, num_batch))
+    state[0:3] = initial_states
+    state[3:] = np.eye(3).reshape(9, 1)
+
+    derivative = tangent_linear_derivative(state, *params)
+    advance = create_stepper(tangent_linear_derivative, delta_t, integrator, n_substeps, rtol, atol)
+
+    log_growth = np.zeros((3, num_batch))
+    growth = np.ones((num_timesteps + 1, num_batch))
+    for i in range(1, num_timesteps + 1):
+        advance(state, derivative, params)
+
+        if i % renormalize_every == 0 or i == num_timesteps:
+            # Batched QR of the (nbatch x component x vector) matrices of tangent vectors
+            Q, R = np.linalg.qr(state[3:].reshape(3, 3, num_batch).transpose(2, 1, 0))
+            log_growth += np.log(np.abs(np.diagonal(R, axis1=1, axis2=2))).T
+            state[3:] = Q.transpose(2, 1, 0).reshape(9, num_batch)
+            # The tangent vectors have changed, so their derivative is re-evaluated for the next step
+            tangent_linear_derivative(state, *params, out=derivative)
+
+        # The first tangent vector is only ever rescaled by the QR, by the growth accumulated on R[0, 0]
+        growth[i] = np.exp(log_growth[0]) * np.linalg.norm(state[3:6], axis=0)
+
+    exponents = log_growth / (num_timesteps * delta_t)
+
+    return (exponents, growth) if return_growth else exponents
+
+
+def error_growth(initial_states, rho, psi, beta, t_array, delta_t, perturbation_size=1e-6, rng=None,
+                 integrator='euler', n_substeps=1, rtol=1e-6, atol=1e-6):
+    """Nonlinear error growth curves: every run is integrated alongside a twin displaced by perturbation_size
+    in a random direction, both in the same batch
+
+    Returns the growth of the separation, |x_twin - x| / perturbation_size (ntimesteps x nbatch). Unlike the
+    tangent linear curves of finite_time_lyapunov_exponents, these include the saturation of finite errors
+    """
+
+    if rng is None:
+        rng = np.random.default_rng()
+
+    initial_states = np.asarray(initial_states, dtype=float)
+    num_batch = initial_states.shape[1]
+    params = batch_parameters(num_batch, rho, psi, beta)
+
+    direction = rng.standard_normal((3, num_batch))
+    direction /= np.linalg.norm(direction, axis=0)
+
+    twin_states = np.concatenate([initial_states, initial_states + perturbation_size * direction], axis=1)
+    twin_params = [np.concatenate([param, param]) for param in params]
+
+    state_array = run_lorenz_batch(twin_states, *twin_params, t_array, delta_t, integrator, n_substeps, rtol, atol)
+    separation = np.linalg.norm(state_array[:, :, num_batch:] - state_array[:, :, :num_batch], axis=1)
+
+    return separation / perturbation_size
+
+
+def growth_time(growth, t_array, factor=2.):
+    """First time at which each error growth curve (ntimesteps x nbatch) reaches factor, e.g. the error doubling
+    time that bounds a useful observation interval. NaN where it never does"""
+
+    reached = growth >= factor
+    first = np.argmax(reached, axis=0)
+
+    return np.where(reached.any(axis=0), np.asarray(t_array)[first], np.nan)
@@ -0,0 +1,110 @@
+"""
+
+Lorenz Data Assimilation
+
+Parallel experiment sweeps, with results cached on disk under a hash of their settings
+
+Scripted by dave.casson@usask.ca
+
+"""
+
+import hashlib
+import itertools
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from . import utilities as utils
+
+
+def expand_grid(grid):
+    """Expand a grid of settings e.g. {'num_ens': [50, 100], 'meas_freq': [1, 10]} into a list of overrides,
+    one for every combination"""
+
+    keys = sorted(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[key] for key in keys))]
+
+
+def settings_hash(settings):
+    """Content hash of a settings dictionary, including the seed, used as the cache key of its result"""
+
+    settings_json = json.dumps(settings, sort_keys=True, default=str)
+    return hashlib.sha256(settings_json.encode()).hexdigest()
+
+
+def result_path(settings, cache_dir):
+    """Path of the cached result of a configuration"""
+    return os.path.join(cache_dir, f'{settings_hash(settings)}.npz')
+
+
+def run_configuration(settings, cache_dir):
+    """Run the experiment of one configuration, unless its result is already cached. Returns the result path"""
+
+    #Imported here, so that worker processes only load the model when they have a configuration to run
+    import lorenz_data_assimilation
+
+    path = result_path(settings, cache_dir)
+    if os.path.exists(path):
+        return path
+
+    save_result(path, lorenz_data_assimilation.run_experiment(settings), settings)
+
+    return path
+
+
+def save_result(path, results, settings):
+    """Save a dictionary of result arrays with the settings they were run with, see load_result"""
+
+    results = dict(results, settings=np.array(json.dumps(settings, sort_keys=True, default=str)))
+
+    utils.atomic_savez(path, **results)
+
+
+def load_result(path):
+    """Load a cached result into a dictionary of arrays, with the settings it was run with"""
+
+    with np.load(path) as data:
+        results = {key: data[key] for key in data.files}
+    results['settings'] = json.loads(str(results['settings']))
+
+    return results
+
+
+def sweep_settings(overrides, settings_filename='settings.ini', seed=0):
+    """Apply each override on top of the settings file. Configurations without a seed are given the sweep seed,
+    so that every result is reproducible, and run with the serial backend inside the sweep worker"""
+
+    base_settings = utils.read_settings(settings_filename)
+
+    configurations = []
+    for override in overrides:
+        settings = dict(base_settings)
+        settings['seed'] = seed
+        settings.update(override)
+        settings['backend'] = 'serial'
+        configurations.append(settings)
+
+    return configurations
+
+
+def run_sweep(overrides, settings_filename='settings.ini', cache_dir='sweep_cache', num_workers=None, seed=0):
+    """Run a list of settings overrides (see expand_grid) on a process pool
+
+    Results already in cache_dir are reused, so re-running a sweep only computes configurations that changed.
+    Returns the result path of every override, in order
+    """
+
+    os.makedirs(cache_dir, exist_ok=True)
+    configurations = sweep_settings(overrides, settings_filename, seed)
+
+    pending = [settings for settings in configurations if not os.path.exists(result_path(settings, cache_dir))]
+    logging.info(f'Sweep of {len(configurations)} configurations, {len(configurations) - len(pending)} cached')
+
+    if pending:
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            list(pool.map(run_configuration, pending, itertools.repeat(cache_dir)))
+
+    return [result_path(settings, cache_dir) for settings in configurations]
@@ -0,0 +1,185 @@
+"""
+
+Lorenz Data Assimilation
+
+On-disk store of ensemble trajectories, estimates, truth and observations
+
+A store is a directory with one .npy file per variable, read back as memory maps, and a metadata.json sidecar.
+With compression, the timestep-indexed variables are instead written as compressed chunks of chunk_size timesteps,
+and only the chunks covering a requested time window are read.
+
+Scripted by dave.casson@usask.ca
+
+"""
+
+import json
+import os
+
+import numpy as np
+
+METADATA_FILENAME = 'metadata.json'
+
+# Variables written timestep by timestep from an ensemble stream, (ntimesteps x nstate x nens) and (ntimesteps x nstate)
+STREAMED_VARIABLES = ('ensemble', 'estimate')
+
+
+def chunk_filename(directory, name, chunk):
+    return os.path.join(directory, f'{name}_{chunk:06d}.npz')
+
+
+class TrajectoryWriter:
+    """Streams an ensemble run into a store, subscribing to the stream like EnsembleStatistics,
+    e.g. broadcast_stream(stream_ensemble(...), [writer])
+
+    compression None writes the ensemble and estimates into .npy memory maps as they arrive. compression 'zlib'
+    buffers chunk_size timesteps and writes each full chunk as a compressed .npz. Other arrays (truth, observations,
+    the time array) are written whole with write_array. The metadata is written by close, which completes the store.
+    With append, the memory maps of an existing uncompressed store are reopened, e.g. for a resumed run.
+    dtype is the floating point type of the streamed variables, e.g. float32 to halve the size of the store.
+    """
+
+    def __init__(self, directory, num_timesteps, n_state, num_ens, compression=None, chunk_size=100,
+                 attributes=None, append=False, dtype=np.float64):
+
+        if compression not in (None, 'zlib'):
+            raise ValueError(f'Unknown compression {compression}, use None or zlib')
+        if append and compression is not None:
+            raise ValueError('Only an uncompressed store can be appended to')
+
+        os.makedirs(directory, exist_ok=True)
+
+        self.directory = directory
+        self.compression = compression
+        self.chunk_size = chunk_size
+        self.attributes = dict(attributes or {})
+        self.shapes = {'ensemble': (num_timesteps, n_state, num_ens), 'estimate': (num_timesteps, n_state)}
+        self.arrays = {}
+        self.variables = {}
+
+        for name in STREAMED_VARIABLES:
+            shape = self.shapes[name]
+            if compression is None:
+                mode = 'r+' if append and os.path.exists(self.path(name)) else 'w+'
+                self.arrays[name] = np.lib.format.open_memmap(self.path(name), mode=mode, dtype=dtype, shape=shape)
+            else:
+                self.arrays[name] = np.full((chunk_size,) + shape[1:], np.nan, dtype=dtype)
+            self.variables[name] = {'shape': list(shape), 'dtype': str(np.dtype(dtype)),
+                                    'chunked': compression is not None}
+
+        if append and os.path.exists(os.path.join(directory, METADATA_FILENAME)):
+            with open(os.path.join(directory, METADATA_FILENAME)) as metadata_file:
+                metadata = json.load(metadata_file)
+            self.variables = dict(metadata['variables'], **self.variables)
+            self.attributes = dict(metadata['attributes'], **self.attributes)
+
+    def path(self, name):
+        return os.path.join(self.directory, f'{name}.npy')
+
+    def update(self, i, state_estimate, state_timestep_array):
+        """Write timestep i, the estimate (nstate) and the ensemble (nstate x nens). An ensemble smaller than the
+        store, e.g. an adaptive ensemble, fills its first members and the rest are NaN"""
+
+        n = i if self.compression is None else i % self.chunk_size
+        num_members = np.shape(state_timestep_array)[1]
+        self.arrays['estimate'][n] = state_estimate
+        self.arrays['ensemble'][n, :, :num_members] = state_timestep_array
+        self.arrays['ensemble'][n, :, num_members:] = np.nan
+        if self.compression is not None and (n == self.chunk_size - 1 or i == self.shapes['estimate'][0] - 1):
+            self.write_chunk(i // self.chunk_size, n + 1)
+
+    __call__ = update
+
+    def write_chunk(self, chunk, length):
+        for name in STREAMED_VARIABLES:
+            np.savez_compressed(chunk_filename(self.directory, name, chunk), values=self.arrays[name][:length])
+            self.arrays[name].fill(np.nan)
+
+    def write_array(self, name, array):
+        """Write a whole array, e.g. the truth run (nstate x ntimesteps) or the observation values"""
+
+        array = np.asarray(array)
+        np.save(self.path(name), array)
+        self.variables[name] = {'shape': list(array.shape), 'dtype': str(array.dtype), 'chunked': False}
+
+    def write_observations(self, observations):
+        """Write the sparse Observations as observation_index, observation_values and observation_variance"""
+        for field, array in zip(observations._fields, observations):
+            self.write_array(f'observation_{field}', array)
+
+    def close(self):
+        """Flush the memory maps and write the metadata sidecar"""
+
+        if self.compression is None:
+            for name in STREAMED_VARIABLES:
+                self.arrays[name].flush()
+        self.arrays = {}
+
+        metadata = {'compression': self.compression,
+                    'chunk_size': self.chunk_size,
+                    'variables': self.variables,
+                    'attributes': self.attributes}
+        with open(os.path.join(self.directory, METADATA_FILENAME), 'w') as metadata_file:
+            json.dump(metadata, metadata_file, indent=2, default=str)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class TrajectoryReader:
+    """Reads a store written by TrajectoryWriter. Uncompressed variables are memory mapped, so reading a time
+    window or a subset of members only touches that part of the file"""
+
+    def __init__(self, directory):
+
+        self.directory = directory
+        with open(os.path.join(directory, METADATA_FILENAME)) as metadata_file:
+            metadata = json.load(metadata_file)
+
+        self.compression = metadata['compression']
+        self.chunk_size = metadata['chunk_size']
+        self.variables = metadata['variables']
+        self.attributes = metadata['attributes']
+
+    def shape(self, name):
+        return tuple(self.variables[name]['shape'])
+
+    def memmap(self, name):
+        """Read-only memory map of an uncompressed variable"""
+
+        if self.variables[name]['chunked']:
+            raise ValueError(f'{name} is stored in compressed chunks, use read')
+        return np.load(os.path.join(self.directory, f'{name}.npy'), mmap_mode='r')
+
+    def read(self, name, start=0, stop=None, members=slice(None)):
+        """Read timesteps start:stop of a variable, and for the ensemble only the selected members (a slice or
+        an index array). Arrays written whole are indexed along their first axis"""
+
+        num_timesteps = self.shape(name)[0]
+        start, stop, _ = slice(start, stop).indices(num_timesteps)
+
+        if not self.variables[name]['chunked']:
+            values = self.memmap(name)[start:stop]
+        else:
+            first_chunk, last_chunk = start // self.chunk_size, max(start, stop - 1) // self.chunk_size
+            chunks = []
+            for chunk in range(first_chunk, last_chunk + 1):
+                with np.load(chunk_filename(self.directory, name, chunk)) as data:
+                    chunks.append(data['values'])
+            offset = first_chunk * self.chunk_size
+            values = np.concatenate(chunks)[start - offset:stop - offset]
+
+        if name == 'ensemble':
+            values = values[..., members]
+
+        return np.array(values)
+
+    def read_window(self, name, t_start, t_end, members=slice(None)):
+        """Read the timesteps with t_start <= t < t_end, using the stored t_array"""
+
+        t_array = self.memmap('t_array')
+        start, stop = np.searchsorted(t_array, [t_start, t_end])
+
+        return self.read(name, start, stop, members)
@@ -0,0 +1,97 @@
+"""
+
+Lorenz Data Assimilation
+
+Disk cache of the base ("truth") and modified runs and their observations, which only depend on a few settings
+
+Scripted by dave.casson@usask.ca
+
+"""
+
+import logging
+import os
+
+import numpy as np
+
+from .sweep import settings_hash
+from .lorenz_array_prep import Observations
+from .models import get_model
+from .utilities import atomic_savez
+
+# Settings the truth and modified runs, and the observations of the truth, are computed from
+TRUTH_SETTINGS = ('delta_t', 'num_timesteps', 'integrator', 'n_substeps', 'rtol', 'atol',
+                  'meas_freq', 'measurement_var')
+
+# Further settings of the truth of each model, its parameters, initial conditions and observation operator
+MODEL_TRUTH_SETTINGS = {'lorenz63': ('rho_base', 'psi_base', 'beta_base', 'u_ini_base', 'v_ini_base', 'w_ini_base',
+                                     'rho_mod', 'psi_mod', 'beta_mod', 'u_ini_mod', 'v_ini_mod', 'w_ini_mod',
+                                     'u_h', 'v_h', 'w_h'),
+                        'lorenz96': ('forcing_base', 'forcing_mod', 'l96_dimension', 'l96_perturbation',
+                                     'l96_obs_every')}
+
+
+def truth_path(cache_dir, settings):
+    """Cache file of the truth of a configuration, named by the hash of the truth settings"""
+
+    model_name = get_model(settings).name
+    truth_settings = {key: settings[key] for key in TRUTH_SETTINGS + MODEL_TRUTH_SETTINGS[model_name]}
+    return os.path.join(cache_dir, f'{settings_hash(dict(truth_settings, model=model_name))}.npz')
+
+
+def load_truth(cache_dir, settings):
+    """Return the cached (t_array, base run, modified run, observations) of the configuration, or None
+
+    A hit refreshes the modification time of the file, which orders the least recently used eviction
+    """
+
+    path = truth_path(cache_dir, settings)
+
+    try:
+        with np.load(path) as data:
+            truth = (data['t_array'], data['base_run'], data['mod_run'],
+                     Observations(data['observation_index'], data['observation_values'],
+                                  data['observation_variance']))
+        os.utime(path)
+    except (OSError, KeyError):
+        #Not cached, or evicted by another process while being read
+        return None
+
+    logging.info(f'Reusing the truth and modified runs cached in {path}')
+    return truth
+
+
+def store_truth(cache_dir, settings, t_array, state_array_base_run, state_array_mod_run, observations, max_bytes):
+    """Add the truth of a configuration to the cache, then evict the least recently used files beyond max_bytes"""
+
+    os.makedirs(cache_dir, exist_ok=True)
+    path = truth_path(cache_dir, settings)
+
+    #Concurrent runs never read a partial file
+    atomic_savez(path, t_array=t_array, base_run=state_array_base_run, mod_run=state_array_mod_run,
+                 observation_index=observations.index, observation_values=observations.values,
+                 observation_variance=observations.variance)
+
+    evict(cache_dir, max_bytes)
+
+
+def evict(cache_dir, max_bytes):
+    """Remove the least recently used cache files until the cache holds at most max_bytes"""
+
+    entries = []
+    for filename in os.listdir(cache_dir):
+        if filename.endswith('.npz') and '.tmp.' not in filename:
+            try:
+                stat = os.stat(os.path.join(cache_dir, filename))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, filename in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, filename))
+        except OSError:
+            pass
+        total_bytes -= size
@@ -11,6 +11,7 @@ Scripted by dave.casson@usask.ca
 import configparser
 import logging
 import ast
+import os
 import numpy as np
 
 def read_settings(settings_filename='settings.ini'):
@@ -34,14 +35,24 @@ def read_settings(settings_filename='settings.ini'):
             try:
                 settings[key] = float(value)
             except ValueError:
-                try:
-                    settings[key] = bool(value)
-                except ValueError:
+                #Only True and False are read as booleans, other text remains a string
+                if value.lower() in ('true', 'false'):
+                    settings[key] = value.lower() == 'true'
+                else:
                     settings[key] = str(value)
 
     return settings
 
 
+def atomic_savez(path, **arrays):
+    """Save the arrays as an uncompressed .npz at path, written to a temporary file first and then moved into place,
+    so that an interrupted write never leaves a partial file and concurrent readers never see one"""
+
+    temporary_path = f'{path}.{os.getpid()}.tmp.npz'
+    np.savez(temporary_path, **arrays)
+    os.replace(temporary_path, path)
+
+
 def outer_product_sum(A, B=None):
 
     """"Original Code Credit: https://github.com/rlabbe/filterpy/blob/master/filterpy/common/helpers.py"""
@@ -85,3 +96,12 @@ def outer_product_sum(A, B=None):
 
     outer = np.einsum('ij,ik->ijk', A, B)
     return np.sum(outer, axis=0)
+
+
+def cholesky_solve(A, B):
+    """Solve A X = B for a symmetric positive definite matrix A, using its Cholesky factor A = L L^T"""
+
+    #Imported here, so that only the EnKF analysis loads scipy
+    from scipy.linalg import cho_factor, cho_solve
+
+    return cho_solve(cho_factor(A, lower=True), B)
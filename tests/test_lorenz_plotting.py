@@ -0,0 +1,22 @@
+"""
+
+Lorenz Data Assimilation
+
+Tests of the plotting functions
+
+Scripted by dave.casson@usask.ca
+
+"""
+
+import numpy as np
+
+from scripts import lorenz_plotting
+
+
+def test_plot_da_results_parallel_without_filters():
+    """No filters to plot gives no figures, without starting a worker pool"""
+
+    state_array = np.zeros((3, 10))
+    t_array = np.arange(10)
+
+    assert lorenz_plotting.plot_da_results_parallel({}, state_array, state_array, None, {}, t_array) == []